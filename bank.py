@@ -2,79 +2,480 @@
 This code provides a Bank class to store items and to include methods like
  inserting a proposal to itself or if a proposal has been covered in this bank.
 """
-import bisect
-from operator import attrgetter
+import itertools
 
 import numpy as np
-import matplotlib.pyplot as plt
 
+from eventlog import ACCEPT, PAIR, PROPOSAL, WINDOW
 
-class LazyNHoods(object):
-    __slots__ = ("seq", "nhood_param")
 
-    def __init__(self, seq, nhood_param):
-        self.seq = seq
+def _grow(arr, size, n):
+    """Return arr if it has room for size rows, otherwise a copy of its first n rows with (at least) doubled capacity."""
+    if size <= len(arr):
+        return arr
+    new = np.empty((max(size, 2 * len(arr), 16),) + arr.shape[1:], dtype=arr.dtype)
+    new[:n] = arr[:n]
+    return new
+
+
+class SortedIndex(object):
+    """
+    Base class of neighborhood indices which keep the rows of a bank sorted by a scalar key,
+     so that the candidates of a proposal are found by bisecting the sorted keys for one or more ranges.
+    """
+    __slots__ = ('bank', 'nhood_size', 'nhood_param', '_order', '_keys', '_size')
+    key_dtype = float
+
+    def __init__(self, bank, nhood_size, nhood_param):
+        self.bank = bank
+        self.nhood_size = nhood_size
         self.nhood_param = nhood_param
+        self._order = np.empty(0, dtype=np.intp)
+        self._keys = np.empty(0, dtype=self.key_dtype)
+        self._size = 0
 
-    def __getitem__(self, idx):
-        return getattr(self.seq[idx], self.nhood_param)
+    def _param_keys(self, params):
+        """Return the keys of points given as an (m, d) array."""
+        raise NotImplementedError
 
-    def __len__(self):
-        return len(self.seq)
+    def _row_keys(self, rows):
+        """Return the keys of the templates stored in rows of the bank."""
+        return self._param_keys(self.bank._params[rows])
+
+    def _ranges(self, params, max_distance):
+        """Return (low, high), two (m, r) arrays of index ranges in the sorted keys holding the candidates."""
+        raise NotImplementedError
+
+    def order(self):
+        return self._order[:self._size]
+
+    def get_state(self):
+        return {'order': self._order[:self._size], 'keys': self._keys[:self._size]}
+
+    def set_state(self, state):
+        self._order = np.array(state['order'], dtype=np.intp)
+        self._keys = np.array(state['keys'], dtype=self.key_dtype)
+        self._size = len(self._order)
+
+    def insert(self, row):
+        n = self._size
+        self._order = _grow(self._order, n + 1, n)
+        self._keys = _grow(self._keys, n + 1, n)
+        key = self._row_keys([row])[0]
+        ind = np.searchsorted(self._keys[:n], key, side='left')
+        self._keys[ind+1:n+1] = self._keys[ind:n]
+        self._keys[ind] = key
+        self._order[ind+1:n+1] = self._order[ind:n]
+        self._order[ind] = row
+        self._size = n + 1
+
+    def extend(self, rows, perm=None):
+        """Add rows to the index, perm is their sorted order if it is known already (e.g. stored in a bank file)."""
+        n, m = self._size, len(rows)
+        self._order = _grow(self._order, n + m, n)
+        self._keys = _grow(self._keys, n + m, n)
+        # sort the new rows only and merge them into the sorted index; a stable sort and
+        # bisecting to the right keep the existing templates in front of new ones with equal keys
+        new_keys = self._row_keys(rows)
+        if perm is None:
+            perm = np.argsort(new_keys, kind='stable')
+        new_keys, rows = new_keys[perm], np.asarray(rows)[perm]
+        pos = np.searchsorted(self._keys[:n], new_keys, side='right') + np.arange(m)
+        old = np.ones(n + m, dtype=bool)
+        old[pos] = False
+        for arr, new in ((self._keys, new_keys), (self._order, rows)):
+            arr[:n+m][old] = arr[:n].copy()
+            arr[pos] = new
+        self._size = n + m
+
+    def candidates(self, params, max_distance):
+        """Return the rows of the templates to be compared with the proposal at params, in order of examination."""
+        low, high = self._ranges(np.reshape(params, (1, -1)), max_distance)
+        return np.concatenate([self._order[l:h] for l, h in zip(low[0], high[0])])
+
+    def pairs(self, params, max_distance, max_pairs=2**20):
+        """
+        Yield (prop_idx, rows) chunks of about max_pairs (proposal, template) pairs which
+         cover all the candidates of the proposals given as an (m, d) array params.
+        """
+        low, high = self._ranges(params, max_distance)
+        n_ranges = low.shape[1]
+        low, high = low.ravel(), high.ravel()
+        counts = high - low
+        ends = np.cumsum(counts)
+        start = 0
+        while start < len(counts):
+            # take at least one range, and as many more as fit in max_pairs
+            first_pair = ends[start] - counts[start]
+            stop = max(start + 1, np.searchsorted(ends, first_pair + max_pairs, side='right'))
+            n_pairs = counts[start:stop]
+            range_idx = np.repeat(np.arange(start, stop), n_pairs)
+            # position of every pair inside its range
+            offsets = np.arange(len(range_idx)) - np.repeat(ends[start:stop] - n_pairs - first_pair, n_pairs)
+            yield range_idx // n_ranges, self._order[offsets + np.repeat(low[start:stop], n_pairs)]
+            start = stop
+
+
+class WindowIndex(SortedIndex):
+    """Sort the templates along nhood_param and take those within nhood_size of the proposal as candidates."""
+    __slots__ = ()
+
+    def _param_keys(self, params):
+        if self.nhood_param == 'norm':
+            return self.bank.tmplt_class.distances(params)
+        return params[:, self.bank.tmplt_class.param_names.index(self.nhood_param)]
+
+    def _row_keys(self, rows):
+        if self.nhood_param == 'norm':
+            return self.bank._norm[rows]
+        return super()._row_keys(rows)
+
+    def _ranges(self, params, max_distance):
+        low, high = _find_neighborhood(self._keys[:self._size], self._param_keys(params), self.nhood_size)
+        return low[:, None], high[:, None]
+
+    def candidates(self, params, max_distance):
+        prop_nhd = self._param_keys(np.reshape(params, (1, -1)))[0]
+        low, high = _find_neighborhood(self._keys[:self._size], prop_nhd, self.nhood_size)
+        # sort the window by its nearness to the proposal
+        return self._order[low:high][np.argsort(np.abs(self._keys[low:high] - prop_nhd), kind='stable')]
+
+
+class GridIndex(SortedIndex):
+    """
+    Uniform cell list of square (cubic, in d dimensions) cells with side nhood_size, the templates are sorted
+     by their cell and the candidates are those in the cells overlapping the bounding box of the proposal's ellipse.
+    The cell indices along the d axes are packed into one 64-bit key, 64 // d bits each.
+    """
+    __slots__ = ('_columns',)
+    key_dtype = np.int64
+
+    def __init__(self, bank, nhood_size, nhood_param):
+        super().__init__(bank, nhood_size, nhood_param)
+        # (max_distance, half axes of the bounding box, column offsets and their keys), max_distance is
+        # constant for a run
+        self._columns = (None, None, None, None)
+
+    def _cells(self, params):
+        return np.floor(np.asarray(params) / self.nhood_size).astype(np.int64)
+
+    @staticmethod
+    def _cell_keys(prefix, last):
+        """
+        Return the keys of the cells whose indices along all the axes but the last one are prefix, an (..., d-1)
+         array, and along the last one last. Cells are sorted by their prefix and then along the last axis,
+         so a column of cells (along the last axis) is a contiguous range; in 2d this is (ix << 32) + iy.
+        """
+        bits = 64 // (prefix.shape[-1] + 1)
+        key = np.zeros(prefix.shape[:-1], dtype=np.int64)
+        for i in range(prefix.shape[-1]):
+            key = (key << bits) + prefix[..., i]
+        return (key << bits) + last
+
+    def _param_keys(self, params):
+        cells = self._cells(params)
+        return self._cell_keys(cells[:, :-1], cells[:, -1])
+
+    def _column_offsets(self, max_distance):
+        """
+        Return (half, offsets, offset_keys): the half axes of the bounding box of the ellipse at max_distance,
+         the offsets of the columns overlapping such a box along all the axes but the last one, and the keys
+         of these offsets (keys are linear in the cell indices), cached for max_distance.
+        """
+        if self._columns[0] != max_distance:
+            half = max_distance * self.bank.tmplt_class.half_axes
+            n_cols = np.ceil(2 * half[:-1] / self.nhood_size).astype(int) + 1
+            offsets = np.stack(np.meshgrid(*map(np.arange, n_cols), indexing='ij'), axis=-1).reshape(-1, len(n_cols))
+            self._columns = (max_distance, half, offsets, self._cell_keys(offsets, 0))
+        return self._columns[1:]
+
+    def _ranges(self, params, max_distance):
+        half, offsets, _ = self._column_offsets(max_distance)
+        lo, hi = self._cells(params - half), self._cells(params + half)
+        prefix = lo[:, None, :-1] + offsets
+        keys = self._keys[:self._size]
+        low = np.searchsorted(keys, self._cell_keys(prefix, lo[:, -1:]), side='left')
+        high = np.searchsorted(keys, self._cell_keys(prefix, hi[:, -1:]), side='right')
+        return low, np.where((prefix <= hi[:, None, :-1]).all(axis=2), high, low)
+
+    def candidates(self, params, max_distance):
+        # the same ranges as _ranges() for a single proposal; keys are integers, so bisecting left
+        # for hi + 1 is bisecting right for hi
+        half, offsets, offset_keys = self._column_offsets(max_distance)
+        size = self.nhood_size
+        params = np.ravel(params)
+        lo = np.floor((params - half) / size).astype(np.int64)
+        hi = np.floor((params + half) / size).astype(np.int64)
+        keys = self._keys[:self._size]
+        if len(offsets) > 16:
+            # the many columns of higher dimensions (3^(d-1) for the default neighborhood size), in bulk
+            columns = self._cell_keys(lo[:-1], 0) + offset_keys[(offsets <= hi[:-1] - lo[:-1]).all(axis=1)]
+            low = np.searchsorted(keys, columns + lo[-1], side='left')
+            high = np.searchsorted(keys, columns + (hi[-1] + 1), side='left')
+            low, high = low[high > low], high[high > low]
+            counts = high - low
+            # the rows of all the ranges, one after the other
+            return self._order[np.repeat(low - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+        # a few columns, with Python scalars which are much faster than numpy on arrays of a few items
+        lo, hi = lo.tolist(), hi.tolist()
+        bits = 64 // len(lo)
+        bounds = []
+        for prefix in itertools.product(*[range(l, h + 1) for l, h in zip(lo[:-1], hi[:-1])]):
+            key = 0
+            for cell in prefix:
+                key = (key << bits) + cell
+            key <<= bits
+            bounds += (key + lo[-1], key + hi[-1] + 1)
+        ends = np.searchsorted(keys, bounds, side='left').tolist()
+        return np.concatenate([self._order[l:h] for l, h in zip(ends[::2], ends[1::2])])
+
+
+class KDTreeIndex(object):
+    """
+    Whiten the parameters with the Cholesky factor of the metric, so that the proper distance becomes
+     the Euclidean one, and search the nearest templates with a k-d tree (requires scipy).
+    The tree is rebuilt from time to time, templates inserted after the last rebuild are kept
+     in a small side buffer which is searched by brute force.
+    """
+    __slots__ = ('bank', 'nhood_size', 'nhood_param', '_tree', '_tree_size', '_size')
+    min_buffer = 256
+
+    def __init__(self, bank, nhood_size, nhood_param="kdtree"):
+        self.bank = bank
+        self.nhood_size = nhood_size
+        self.nhood_param = nhood_param
+        self._tree = None
+        self._tree_size = 0
+        self._size = 0
+
+    def _whiten(self, params):
+        return np.asarray(params) @ self.bank.tmplt_class.chol
+
+    def _rebuild(self):
+        from scipy.spatial import cKDTree
+        self._tree = cKDTree(self._whiten(self.bank._params[:self._size]))
+        self._tree_size = self._size
+
+    def order(self):
+        return np.arange(self._size)
+
+    def get_state(self):
+        return {'tree_size': np.array(self._tree_size)}
+
+    def set_state(self, state):
+        # the tree is built from the same rows, which gives the very same tree
+        self._size = int(state['tree_size'])
+        self._tree, self._tree_size = None, 0
+        if self._size:
+            self._rebuild()
+        self._size = len(self.bank)
+
+    def insert(self, row):
+        self._size += 1
+        if self._size - self._tree_size > max(self.min_buffer, 4 * int(np.sqrt(self._size))):
+            self._rebuild()
+
+    def extend(self, rows, perm=None):
+        self._size += len(rows)
+        self._rebuild()
+
+    def candidates(self, params, max_distance):
+        """Return the rows of the nearest templates in the tree and in the buffer, the nearest first."""
+        y = self._whiten(np.reshape(params, (1, -1)))
+        rows, dists = [], []
+        if self._tree is not None and self._tree_size:
+            dist, row = self._tree.query(y[0])
+            rows.append(row)
+            dists.append(dist)
+        if self._size > self._tree_size:
+            dist = np.linalg.norm(self._whiten(self.bank._params[self._tree_size:self._size]) - y, axis=1)
+            row = np.argmin(dist)
+            rows.append(self._tree_size + row)
+            dists.append(dist[row])
+        return np.array(rows, dtype=np.intp)[np.argsort(dists)]
+
+    def pairs(self, params, max_distance, max_pairs=2**20):
+        """
+        Yield (prop_idx, rows) chunks of (proposal, template) pairs holding, for each of the proposals
+         given as an (m, d) array params, every template of the tree and of the buffer within max_distance.
+        """
+        # leave some room for the rounding errors of the whitening, the Bank computes the exact distances
+        bound = max_distance * (1 + 1e-9)
+        y = self._whiten(params)
+        if self._tree is not None and self._tree_size:
+            # only a few templates lie within max_distance of a point
+            step = max(1, max_pairs // 64)
+            for start in range(0, len(y), step):
+                hits = self._tree.query_ball_point(y[start:start+step], bound)
+                counts = np.fromiter(map(len, hits), dtype=np.intp, count=len(hits))
+                rows = np.fromiter(itertools.chain.from_iterable(hits), dtype=np.intp, count=int(counts.sum()))
+                yield start + np.repeat(np.arange(len(hits)), counts), rows
+        buffer = np.arange(self._tree_size, self._size)
+        if len(buffer):
+            y_buffer = self._whiten(self.bank._params[buffer])
+            step = max(1, max_pairs // len(buffer))
+            for start in range(0, len(y), step):
+                dist = np.linalg.norm(y[start:start+step, None, :] - y_buffer[None, :, :], axis=2)
+                prop_idx, j = np.nonzero(dist <= bound)
+                yield start + prop_idx, buffer[j]
+
+
+def _local_width(tmplt_class):
+    """Number of the coefficients of the local metric kept for each template, none for a constant metric."""
+    return len(tmplt_class.coeffs) if tmplt_class is not None and tmplt_class.varying_metric else 0
 
 
 class Bank(object):
-    __slots__ = ('nhood_size', 'nhood_param', '_templates', '_nmatch', '_NHoods', '_ax')
+    """
+    Templates are stored column-wise in contiguous arrays (parameters, norm and a seed-point mask)
+     in the order they were added, these arrays grow by amortized doubling.
+    The parameters are an (n, d) array, d being the dimension (ndim) of the template class.
+    For template classes with a varying metric, the coefficients of the local metric of each template
+     are kept in another column, which is filled in lazily the first time the template is compared.
+    Finding the templates near a proposal is left to the neighborhood index chosen by nhood_param,
+     see nhood_indices.
+    If an EventLog is given as events, what covers() and insort() do is recorded there for plotting.
+    """
+    __slots__ = ('nhood_size', 'nhood_param', 'tmplt_class', '_params', '_norm', '_is_seed', '_local',
+                 '_index', '_size', '_nmatch', '_ncovers', '_nwindows',
+                 '_ncandidates', '_nexamined', '_max_candidates', '_events')
 
-    def __init__(self, nhood_size=1.0, nhood_param="x1", if_plot=False):
+    def __init__(self, nhood_size=1.0, nhood_param="x1", events=None, tmplt_class=None):
         self.nhood_size = nhood_size
         self.nhood_param = nhood_param
+        self.tmplt_class = tmplt_class
 
-        self._templates = []
+        self._params = np.empty((0, 2 if tmplt_class is None else tmplt_class.ndim))
+        self._norm = np.empty(0)
+        self._is_seed = np.empty(0, dtype=bool)
+        self._local = np.empty((0, _local_width(tmplt_class)))
+        self._index = nhood_indices[nhood_param](self, nhood_size, nhood_param)
+        self._size = 0
         self._nmatch = 0
-        self._NHoods = LazyNHoods(self._templates, self.nhood_param)
-        if if_plot:
-            fig, ax = plt.subplots(figsize=(6, 6))
-            ax.set_xlabel('x', fontsize=24)
-            ax.set_ylabel('y', fontsize=24)
-            ax.set_xlim(0, 1)
-            ax.set_ylim(0, 1)  # TODO: improve these hard-coded settings
-            ax.tick_params(labelsize=16)
-            ax.grid(which='both', zorder=1, alpha=0.5)
-            ax.set_aspect('equal')
-            fig.tight_layout()
-            self._ax = ax
-        else:
-            self._ax = None
+        # counters of the neighborhoods looked up by covers() and pairs() and of their candidates,
+        # and of the calls of covers() and the candidates it examined
+        self._ncovers = self._nwindows = self._ncandidates = self._nexamined = self._max_candidates = 0
+        self._events = events
 
     def __len__(self):
-        return len(self._templates)
+        return self._size
 
     def __iter__(self):
-        return iter(self._templates)
+        return (self._template(row) for row in self._index.order())
 
     def __repr__(self):
-        return repr(self._templates)
-
-    def insort(self, new, prefix):
-        ind = bisect.bisect_left(self._NHoods, getattr(new, self.nhood_param))
-        self._templates.insert(ind, new)
-        if self._ax:
-            new.ellipse.set(color='C2')
-            self._ax.add_patch(new.ellipse)
-            dot_tem = self._ax.plot(*new.params, markersize=1, color='C2', marker='.', zorder=3)
-            plt.savefig(f'{prefix}_{self._nmatch:0>6d}_{len(self):0>3d}_0.png')
-            new.ellipse.set(color='C0')
-            dot_tem[0].set(color='C0')
-            plt.savefig(f'{prefix}_{self._nmatch:0>6d}_{len(self):0>3d}_1.png')
-
-    def add_from_array(self, arr, tmplt_class):
-        newtmplts = [tmplt_class(*i) for i in arr]
-        # Mark all templates as seed points
-        for template in newtmplts:
-            template.is_seed_point = True
-        self._templates.extend(newtmplts)
-        self._templates.sort(key=attrgetter(self.nhood_param))
+        return repr(list(self))
+
+    def _reserve(self, size):
+        """Make sure there is room for size templates."""
+        n = self._size
+        self._params = _grow(self._params, size, n)
+        self._norm = _grow(self._norm, size, n)
+        self._is_seed = _grow(self._is_seed, size, n)
+        if self.tmplt_class.varying_metric:
+            self._local = _grow(self._local, size, n)
+
+    def get_state(self):
+        """Return the content of the bank (and of its neighborhood index) as a dict of arrays."""
+        n = self._size
+        state = {'params': self._params[:n], 'norm': self._norm[:n], 'is_seed': self._is_seed[:n],
+                 'nmatch': np.array(self._nmatch)}
+        state.update(('index_' + k, v) for k, v in self._index.get_state().items())
+        return state
+
+    def set_state(self, state):
+        """Replace the content of the bank by the one returned by get_state()."""
+        n = len(state['params'])
+        self._params = np.array(state['params'], dtype=float)
+        self._norm = np.array(state['norm'], dtype=float)
+        self._is_seed = np.array(state['is_seed'], dtype=bool)
+        # the local metrics are not saved, they are evaluated again when needed
+        self._local = np.full((n, _local_width(self.tmplt_class)), np.nan)
+        self._size = n
+        self._nmatch = int(state['nmatch'])
+        self._index.set_state({k[len('index_'):]: v for k, v in state.items() if k.startswith('index_')})
+
+    def counters(self):
+        """
+        Return the counters of the distance calculations as a dict: distance_evaluations (in all),
+         windows (neighborhoods looked up, one per proposal of covers() or point of pairs()), candidates
+         (in these neighborhoods, in all and at most), covers (calls) and examined (by covers(), up to the
+         first template within max_distance, i.e. the depth of the early exit).
+        """
+        return {'distance_evaluations': self._nmatch, 'windows': self._nwindows, 'candidates': self._ncandidates,
+                'max_candidates': self._max_candidates, 'covers': self._ncovers, 'examined': self._nexamined}
+
+    def _template(self, row):
+        """Build a Template() object from the stored row."""
+        tmplt = self.tmplt_class(*self._params[row])
+        tmplt.is_seed_point = bool(self._is_seed[row])
+        return tmplt
+
+    def _local_coeffs(self, rows):
+        """Return the coefficients of the local metric of the templates in rows, or None for a constant metric."""
+        if not self.tmplt_class.varying_metric:
+            return None
+        coeffs = self._local[rows]
+        new = np.isnan(coeffs[:, 0])
+        if new.any():
+            coeffs[new] = self.tmplt_class.coeffs_at(self._params[rows[new]])
+            self._local[rows[new]] = coeffs[new]
+        return coeffs
+
+    def _set_class(self, tmplt_class):
+        """Take tmplt_class as the class of the templates if there is none yet, i.e. if the bank is empty."""
+        if self.tmplt_class is None:
+            self.tmplt_class = tmplt_class
+            self._params = np.empty((0, tmplt_class.ndim))
+            self._local = np.empty((0, _local_width(tmplt_class)))
+
+    def insort(self, new, n_prop=0):
+        self._set_class(type(new))
+        n = self._size
+        self._reserve(n + 1)
+        self._params[n] = new.params
+        self._norm[n] = new.norm
+        self._is_seed[n] = getattr(new, 'is_seed_point', False)
+        if self.tmplt_class.varying_metric:
+            self._local[n] = np.nan if new._local is None else new._local
+        self._size = n + 1
+        self._index.insert(n)
+        if self._events is not None:
+            self._events.append(ACCEPT, n_prop, self._nmatch, self._size, *new.params[:2])
+
+    def add_from_array(self, arr, tmplt_class, is_seed_point=True, order=None):
+        """
+        Add the templates given as an (m, d) array (possibly memory-mapped), without building
+         any Template() object; they are merged into the sorted neighborhood index.
+        order is their sorted order for the neighborhood index of the bank if it is known,
+         e.g. stored in a bank file (see bankfile.py), which saves sorting them.
+        """
+        self._set_class(tmplt_class)
+        n, m = self._size, len(arr)
+        self._reserve(n + m)
+        self._params[n:n+m] = arr
+        self._norm[n:n+m] = tmplt_class.distances(self._params[n:n+m])
+        # Mark all templates as seed points (unless told otherwise)
+        self._is_seed[n:n+m] = is_seed_point
+        if tmplt_class.varying_metric:
+            self._local[n:n+m] = np.nan
+        self._size = n + m
+        self._index.extend(np.arange(n, n+m), None if order is None else np.asarray(order, dtype=np.intp))
+
+    def rows(self, start=0, stop=None):
+        """Return the parameters of the templates from start to stop in the order they were added."""
+        return self._params[start:self._size if stop is None else min(stop, self._size)]
+
+    def order(self):
+        """Return the order of iteration, i.e. the rows sorted by the neighborhood index."""
+        return self._index.order()
+
+    def to_array(self, seeds=True):
+        """Return the parameters of the templates as an (n, d) array, in the order of iteration."""
+        rows = self._index.order()
+        if not seeds:
+            rows = rows[~self._is_seed[rows]]
+        return self._params[rows]
 
     @classmethod
     def from_array(cls, arr, tmplt_class, *args, **kwargs):
@@ -82,78 +483,116 @@ class Bank(object):
         bank.add_from_array(arr, tmplt_class)
         return bank
 
-    def covers(self, proposal, max_distance, prefix):
+    def candidates(self, params, max_distance):
+        """
+        Return the rows of the templates which covers() compares with a proposal at params (a sequence of d
+         parameters) for max_distance, in order of examination; see rows() for their parameters.
+        """
+        return self._index.candidates(params, max_distance)
+
+    def covers(self, proposal, max_distance, n_prop=0):
         """
         Return (min_distance, template) where min_distance is either
         (i) the best found distance if min_distance < max_distance or
         (ii) the distance of the first template found with distance >= max_distance.
         template is the Template() object which yields min_distance.
+        n_prop numbers the proposal in the event log.
         """
+        self._set_class(type(proposal))
         min_distance = np.inf
         template = None
 
         # find templates in the bank "near" this tmplt
-        prop_nhd = getattr(proposal, self.nhood_param)
-        low, high = _find_neighborhood(self._NHoods, prop_nhd, self.nhood_size)
-        tmpbank = self._templates[low:high]
-        if self._ax:
-            ellipse_new = proposal.get_ellipse(max_distance, c='C3')
-            dot_new = self._ax.plot(*proposal.params, markersize=1, color='C3', marker='.', zorder=3)
-            self._ax.add_patch(ellipse_new)
-            if self.nhood_param == 'x1':
-                p = self._ax.axvspan(prop_nhd-self.nhood_size, prop_nhd+self.nhood_size,
-                                     lw=0, color='C1', alpha=0.2, zorder=2)
-            elif self.nhood_param == 'x2':
-                p = self._ax.axhspan(prop_nhd-self.nhood_size, prop_nhd+self.nhood_size,
-                                     lw=0, color='C1', alpha=0.2, zorder=2)
-            else:
-                raise NotImplementedError
-            plt.savefig(f'{prefix}_{self._nmatch:0>6d}_{len(self):0>3d}.png')
-
-        if tmpbank:
-            # sort the bank by its nearness to tmplt
-            tmpbank.sort(key=lambda b: abs(getattr(b, self.nhood_param) - prop_nhd))
-
-            line_new = []
-            # find and test distancees
-            for tmplt in tmpbank:
-
-                self._nmatch += 1
-                distance = tmplt.proper_distance(proposal)
-                if self._ax:
-                    line_new += self._ax.plot([proposal.x1, tmplt.x1], [proposal.x2, tmplt.x2],
-                                              color='C4', lw=1, zorder=3)
-                    # line_new = self._ax.plot([proposal.x1, tmplt.x1], [proposal.x2, tmplt.x2],
-                    #                          color='C4', lw=1, zorder=3)
-                    # plt.savefig(f'{prefix}_{self._nmatch:0>7d}_{len(self):0>3d}.png')
-                    # line_new[0].remove()
-
-                # record distance and template params for largest distance
-                if distance < min_distance:
-                    min_distance = distance
-                    template = repr(tmplt)
-
-                if distance < max_distance:
-                    break
-            if self._ax:
-                plt.savefig(f'{prefix}_{self._nmatch:0>6d}_{len(self):0>3d}.png')
-                for i in line_new:
-                    i.remove()
-
-        if self._ax:
-            ellipse_new.remove()
-            dot_new[0].remove()
-            p.remove()
+        rows = self._index.candidates(proposal.params, max_distance)
+        self._ncovers += 1
+        self._nwindows += 1
+        self._ncandidates += len(rows)
+        if len(rows) > self._max_candidates:
+            self._max_candidates = len(rows)
+        events = self._events
+        if events is not None:
+            events.append(PROPOSAL, n_prop, self._nmatch, self._size, *proposal.params[:2])
+            if self.nhood_param in ('x1', 'x2'):
+                x = proposal.params[self.tmplt_class.param_names.index(self.nhood_param)]
+                events.append(WINDOW, n_prop, self._nmatch, self._size, x - self.nhood_size, x + self.nhood_size)
+
+        if len(rows):
+            # find and test distances against all candidates at once
+            dx = self._params[rows] - proposal.params
+            distances = self.tmplt_class.distances(dx, self._local_coeffs(rows))
+
+            # only the templates up to the first one within max_distance would have been
+            # examined one by one, so account for (and pick the minimum among) those only
+            hits = np.flatnonzero(distances < max_distance)
+            n_examined = hits[0] + 1 if len(hits) else len(rows)
+            self._nmatch += int(n_examined)
+            self._nexamined += int(n_examined)
+            best = np.argmin(distances[:n_examined])
+            min_distance = float(distances[best])
+            template = repr(self._template(rows[best]))
+            if events is not None:
+                events.extend(PAIR, n_prop, self._nmatch, self._size, self._params[rows[:n_examined], :2])
 
         return min_distance, template
 
+    def pairs(self, params, max_distance, max_pairs=2**20):
+        """
+        Yield (prop_idx, rows, distances) chunks of about max_pairs (point, template) pairs, holding all the
+         candidates of the neighborhood index for the points given as an (m, d) array params and their distances.
+        """
+        self._nwindows += len(params)
+        if not self._size:
+            # there is no template, nor maybe a template class yet
+            return
+        params = np.asarray(params, dtype=float).reshape(-1, self._params.shape[1])
+        # the window of a point may be split across chunks
+        sizes = np.zeros(len(params), dtype=np.intp)
+        for prop_idx, rows in self._index.pairs(params, max_distance, max_pairs):
+            self._nmatch += len(rows)
+            self._ncandidates += len(rows)
+            sizes += np.bincount(prop_idx, minlength=len(params))
+            dx = self._params[rows] - params[prop_idx]
+            yield prop_idx, rows, self.tmplt_class.distances(dx, self._local_coeffs(rows))
+        self._max_candidates = max(self._max_candidates, int(sizes.max(initial=0)))
+
+    def covers_many(self, params, max_distance, max_pairs=2**20):
+        """
+        Return a boolean array telling for each row of params (proposals as an (m, d) array)
+        whether some template in its neighborhood lies within max_distance, i.e. whether
+        covers() would find a min_distance < max_distance for it against the current bank.
+        The (proposal, template) pairs are evaluated in chunks of about max_pairs.
+        """
+        covered = np.zeros(len(params), dtype=bool)
+        for prop_idx, _, distances in self.pairs(params, max_distance, max_pairs):
+            covered[prop_idx[distances < max_distance]] = True
+        return covered
+
+    def min_distances(self, params, max_distance, max_pairs=2**20):
+        """
+        Return for each row of params (points as an (m, d) array) the distance to its nearest template among
+         the candidates of the neighborhood index for max_distance, np.inf if there is none.
+        With the grid and kdtree indices, every distance below max_distance is exact.
+        """
+        nearest = np.full(len(params), np.inf)
+        for prop_idx, _, distances in self.pairs(params, max_distance, max_pairs):
+            np.minimum.at(nearest, prop_idx, distances)
+        return nearest
+
 
 def _find_neighborhood(tmplt_locs, prop_loc, nhood_size=0.25):
     """
     Return the min and max indices of templates that cover the given
     template at prop_loc within a parameter difference of nhood_size.
-    tmplt_locs should be a sequence of neighborhood values in sorted order.
+    tmplt_locs should be an array of neighborhood values in sorted order.
     """
-    low_ind = bisect.bisect_left(tmplt_locs, prop_loc - nhood_size)
-    high_ind = bisect.bisect_right(tmplt_locs, prop_loc + nhood_size)
+    low_ind = np.searchsorted(tmplt_locs, prop_loc - nhood_size, side='left')
+    high_ind = np.searchsorted(tmplt_locs, prop_loc + nhood_size, side='right')
     return low_ind, high_ind
+
+
+nhood_indices = {'x1': WindowIndex,
+                 'x2': WindowIndex,
+                 'norm': WindowIndex,
+                 'grid': GridIndex,
+                 'kdtree': KDTreeIndex,
+                 }
@@ -0,0 +1,162 @@
+"""
+This code provides a binary file format for banks, which can be written incrementally during a run
+ and read back memory-mapped.
+
+Layout of a bank file:
+    [0, 8)                      magic number b'SBANK\\x00\\x01\\n' (format version 1)
+    [8, header_size)            JSON header padded with spaces: the generation parameters and the metric,
+                                 'ndim' (the number of parameters, 2 if missing), 'rows' (the number of
+                                 committed rows) and 'order' (see below)
+    [header_size, ...)          rows of float64 (x1, ..., x<ndim>), little-endian, in the order the templates were added
+    [order['offset'], ...)      optionally, the order of the rows sorted by the neighborhood index
+                                 of order['nhood_param'] (and order['nhood_size']), as int64
+
+Rows are appended first and only committed afterwards by rewriting 'rows' in the header, so the file stays
+ consistent if the run crashes: the rows beyond the committed ones are ignored (and overwritten).
+"""
+import json
+import os
+
+import numpy as np
+
+# extension of the output files which are written in this format by sbank.py
+extension = '.bank'
+magic = b'SBANK\x00\x01\n'
+header_size = 4096
+row_dtype = np.dtype('<f8')
+order_dtype = np.dtype('<i8')
+
+
+def is_bank_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(magic)) == magic
+
+
+def _read_header(f):
+    f.seek(0)
+    if f.read(len(magic)) != magic:
+        raise ValueError("%s is not a bank file." % f.name)
+    return json.loads(f.read(header_size - len(magic)))
+
+
+class BankWriter(object):
+    """
+    Writer of a bank file, the rows are appended with append() and committed each time.
+    header is a dict of metadata (JSON-serializable), e.g. made by bank_header().
+    If rows is given, the existing file is opened instead and only (at most) its first rows committed rows
+     are kept, e.g. to continue a run resumed from a checkpoint; its header is kept as well.
+    """
+    __slots__ = ('file', 'header')
+
+    def __init__(self, filename, header=None, rows=None):
+        if rows is None:
+            self.file = open(filename, 'w+b')
+            self.header = dict(header or {}, rows=0, order=None)
+        else:
+            self.file = open(filename, 'r+b')
+            self.header = _read_header(self.file)
+            self.header.update(rows=min(rows, self.header['rows']), order=None)
+        self._commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def rows(self):
+        return self.header['rows']
+
+    @property
+    def ndim(self):
+        return self.header.get('ndim', 2)
+
+    def _commit(self):
+        text = json.dumps(self.header).encode()
+        if len(text) > header_size - len(magic):
+            raise ValueError("The header of the bank file is too large (%d bytes)." % len(text))
+        # make sure that the data is on disk before the header refers to it
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.seek(0)
+        self.file.write(magic + text.ljust(header_size - len(magic)))
+        self.file.flush()
+
+    def append(self, params):
+        """Append the templates given as an (m, ndim) array and commit them."""
+        params = np.ascontiguousarray(params, dtype=row_dtype).reshape(-1, self.ndim)
+        if not len(params):
+            return
+        self.file.seek(header_size + self.rows * self.ndim * row_dtype.itemsize)
+        self.file.truncate()
+        self.file.write(params.tobytes())
+        self.header.update(rows=self.rows + len(params), order=None)
+        self._commit()
+
+    def write_order(self, order, nhood_param, nhood_size):
+        """Store the sorted order of all the rows for the neighborhood index nhood_param (and nhood_size)."""
+        order = np.ascontiguousarray(order, dtype=order_dtype)
+        if len(order) != self.rows:
+            raise ValueError("The order has %d rows, the bank file %d." % (len(order), self.rows))
+        offset = header_size + self.rows * self.ndim * row_dtype.itemsize
+        self.file.seek(offset)
+        self.file.truncate()
+        self.file.write(order.tobytes())
+        self.header['order'] = {'offset': offset, 'nhood_param': nhood_param, 'nhood_size': nhood_size}
+        self._commit()
+
+    def close(self):
+        self.file.close()
+
+
+def read_bank(filename, mmap=True):
+    """
+    Return (header, params, order) of the bank file filename: the (n, ndim) array of the templates (memory-mapped
+     unless mmap is False) and their stored sorted order (None if there is none, see BankWriter.write_order()).
+    """
+    with open(filename, 'rb') as f:
+        header = _read_header(f)
+    n, ndim = header['rows'], header.get('ndim', 2)
+    order = None
+    if mmap and n:
+        params = np.memmap(filename, dtype=row_dtype, mode='r', offset=header_size, shape=(n, ndim))
+        if header['order'] is not None:
+            order = np.memmap(filename, dtype=order_dtype, mode='r', offset=header['order']['offset'], shape=(n,))
+    else:
+        params = np.fromfile(filename, dtype=row_dtype, count=ndim * n, offset=header_size).reshape(n, ndim)
+        if header['order'] is not None:
+            order = np.fromfile(filename, dtype=order_dtype, count=n, offset=header['order']['offset'])
+    return header, params, order
+
+
+def load_params(filename):
+    """Return (params, header) of a bank file, or of a .npy array of shape (d, n) whose header is then empty."""
+    if is_bank_file(filename):
+        header, params, _ = read_bank(filename)
+        return params, header
+    return np.load(filename, mmap_mode='r').T, {}
+
+
+def bank_header(tmplt_class, **metadata):
+    """Return the header of a bank file for templates of tmplt_class, with the generation parameters in metadata."""
+    return dict(metadata, template_class=tmplt_class.__name__, metric=np.asarray(tmplt_class.metric).tolist(),
+                varying_metric=tmplt_class.varying_metric, ndim=tmplt_class.ndim)
+
+
+def write_bank(filename, bank, **metadata):
+    """Write all the templates of bank (a Bank) to a bank file, with their sorted order."""
+    with BankWriter(filename, bank_header(bank.tmplt_class, **metadata)) as writer:
+        writer.append(bank.rows())
+        writer.write_order(bank.order(), bank.nhood_param, bank.nhood_size)
+
+
+def stored_order(header, order, nhood_param, nhood_size):
+    """Return the order read from a bank file if it holds for the neighborhood index nhood_param, else None."""
+    stored = header['order']
+    if order is None or stored['nhood_param'] != nhood_param:
+        return None
+    # the keys of the grid depend on its cell size
+    if nhood_param == 'grid' and stored['nhood_size'] != nhood_size:
+        return None
+    return order
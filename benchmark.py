@@ -0,0 +1,206 @@
+"""
+This code benchmarks bank generation, driving the generation loop of sbank.py and Bank directly, type
+```shell
+python3 benchmark.py --help
+```
+in command line for further help docs.
+
+Every option of the sweep takes a comma-separated list, all combinations are run, e.g.
+```shell
+python3 benchmark.py --distance-max 0.1,0.05 --neighborhood-param x1,norm,grid --output-file bench.json
+```
+or, for the scaling with the dimension of the parameter space,
+```shell
+python3 benchmark.py --coord-frame Cartesian,Cartesian3D,Cartesian4D --distance-max 0.2 --neighborhood-param x1,grid,kdtree
+```
+The results are written as JSON: one record per generation run (proposals/sec, distance evaluations per
+ accepted template, time to convergence, peak memory) and one per bank size (cost of the neighborhood lookup,
+ covers and insort against a bank of random templates).
+"""
+from itertools import product
+from optparse import OptionParser
+from time import perf_counter
+import json
+import platform
+import sys
+import tracemalloc
+
+import numpy as np
+
+from bank import Bank, nhood_indices
+from sbank import _exhaust, generate_iter, make_config
+from stats import RunStats
+from templates import coord_frames, proposal_chunks
+
+
+def _constraints(coord_frame):
+    x2 = (0., np.pi / 2) if coord_frame in ('Polar', 'PolarMetric') else (0., 1.)
+    return dict({'x%d' % i: (0., 1.) for i in range(1, coord_frames[coord_frame].ndim + 1)}, x2=x2)
+
+
+def _nhood_size(tmplt_class, nhood_param, nhood_size, distance_max):
+    # as done by sbank.py, the grid cells are set by the ellipses
+    if nhood_param == 'grid':
+        return distance_max * float(np.sqrt(max(tmplt_class.vals)))
+    return nhood_size
+
+
+def _peak_memory(func, *args, **kwargs):
+    """Return the peak of the memory allocated (in MB) while running func(*args, **kwargs)."""
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def run_generation(coord_frame, distance_max, neighborhood_param, neighborhood_size, convergence_threshold=1000,
+                   max_new_templates=float('inf'), seed=42):
+    """
+    Generate a bank with sbank.generate_iter() (one proposal at a time, as sbank.py does by default) and return
+     a dict of measurements, the time is split between drawing the proposals, covers() and insort().
+    """
+    tmplt_class = coord_frames[coord_frame]
+    constraints = _constraints(coord_frame)
+    limits = {'x%d_%s' % (i, end): value for i in range(1, tmplt_class.ndim + 1)
+              for end, value in zip(('min', 'max'), constraints['x%d' % i])}
+    opts = make_config(coord_frame=coord_frame, distance_max=distance_max, neighborhood_param=neighborhood_param,
+                       neighborhood_size=_nhood_size(tmplt_class, neighborhood_param, neighborhood_size, distance_max),
+                       convergence_threshold=convergence_threshold, max_new_templates=max_new_templates, seed=seed,
+                       **limits)
+    bank = Bank(opts.neighborhood_size, neighborhood_param, tmplt_class=tmplt_class)
+    stats = RunStats()
+
+    start = perf_counter()
+    n_prop = _exhaust(generate_iter(bank, tmplt_class, opts, constraints, stats=stats))
+    elapsed = perf_counter() - start
+    # the run stops at the convergence criterion unless it reaches max_new_templates first
+    converged = len(bank) < max_new_templates
+
+    return {'proposals': n_prop, 'templates': len(bank), 'converged': converged,
+            'time_to_convergence': elapsed if converged else None, 'elapsed': elapsed,
+            'proposals_per_sec': n_prop / elapsed,
+            'distance_evaluations': bank._nmatch,
+            'distance_evaluations_per_template': bank._nmatch / max(len(bank), 1),
+            'time_draw': stats.times['draw'], 'time_covers': stats.times['covers'],
+            'time_insort': stats.times['insort']}
+
+
+def run_bank_size(coord_frame, distance_max, neighborhood_param, neighborhood_size, bank_size, n_proposals=2000,
+                  seed=42):
+    """
+    Measure the cost of the bank operations against a bank seeded with bank_size random templates, drawn as
+     the proposals of a generation run: building it, the candidates of its neighborhood index, covers()
+     and insort() for n_proposals proposals.
+    """
+    tmplt_class = coord_frames[coord_frame]
+    rng = np.random.default_rng(seed)
+    points = next(proposal_chunks[coord_frame](bank_size + n_proposals, rng, **_constraints(coord_frame)))
+    arr = points[:bank_size]
+    tmplts = [tmplt_class(*params) for params in points[bank_size:].tolist()]
+    nhood_size = _nhood_size(tmplt_class, neighborhood_param, neighborhood_size, distance_max)
+
+    start = perf_counter()
+    bank = Bank.from_array(arr, tmplt_class, nhood_size, neighborhood_param)
+    t_build = perf_counter() - start
+
+    start = perf_counter()
+    for tmplt in tmplts:
+        bank.candidates(tmplt.params, distance_max)
+    t_candidates = perf_counter() - start
+
+    start = perf_counter()
+    for tmplt in tmplts:
+        bank.covers(tmplt, distance_max)
+    t_covers = perf_counter() - start
+    nmatch = bank._nmatch
+
+    start = perf_counter()
+    for tmplt in tmplts:
+        bank.insort(tmplt)
+    t_insort = perf_counter() - start
+
+    return {'build_time': t_build, 'candidates_per_sec': n_proposals / t_candidates,
+            'covers_per_sec': n_proposals / t_covers, 'distance_evaluations_per_covers': nmatch / n_proposals,
+            'insort_per_sec': n_proposals / t_insort}
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'argv': sys.argv[1:]}
+
+
+def parse_command_line():
+    parser = OptionParser()
+    parser.add_option("--coord-frame", default="Cartesian", metavar='|'.join(coord_frames.keys()),
+                      help="Coordinate frames to benchmark. Default Cartesian.")
+    parser.add_option("--distance-max", default="0.1,0.05", metavar="FLOAT[,FLOAT...]",
+                      help="Maximum distances to benchmark. Default 0.1,0.05.")
+    parser.add_option("--neighborhood-param", default="x1,norm,grid", metavar='|'.join(nhood_indices.keys()),
+                      help="Neighborhood params to benchmark. Default x1,norm,grid.")
+    parser.add_option("--neighborhood-size", default="0.2", metavar="FLOAT[,FLOAT...]",
+                      help="Neighborhood sizes to benchmark (ignored for grid and kdtree). Default 0.2.")
+    parser.add_option("--bank-size", default="1000,10000,100000", metavar="N[,N...]",
+                      help="Sizes of the random banks to measure covers() and insort() against, empty to skip. Default 1000,10000,100000.")
+    parser.add_option("--convergence-threshold", type="int", metavar="N", default=1000,
+                      help="Convergence criterion of the generation runs, see sbank.py. Default 1000.")
+    parser.add_option("--max-new-templates", type="int", metavar="N", default=float('inf'),
+                      help="Stop the generation runs after N templates.")
+    parser.add_option("--seed", type="int", metavar="INT", default=42,
+                      help="Seed of the random number generator.")
+    parser.add_option("--no-memory", action="store_true", default=False,
+                      help="Do not measure the peak memory, which takes another (traced, slower) generation run.")
+    parser.add_option("--output-file", metavar="FILE", default=None,
+                      help="Write the JSON results to FILE instead of the standard output.")
+    opts_, args_ = parser.parse_args()
+
+    def split(value, kind, choices=None):
+        values = [kind(i) for i in value.split(',') if i]
+        for i in values:
+            if choices is not None and i not in choices:
+                parser.error("invalid choice %r, choose from %s" % (i, ', '.join(choices)))
+        return values
+
+    opts_.coord_frame = split(opts_.coord_frame, str, coord_frames)
+    opts_.distance_max = split(opts_.distance_max, float)
+    opts_.neighborhood_param = split(opts_.neighborhood_param, str, nhood_indices)
+    opts_.neighborhood_size = split(opts_.neighborhood_size, float)
+    opts_.bank_size = split(opts_.bank_size, int)
+    return opts_, args_
+
+
+def main():
+    opts, args = parse_command_line()
+    results = {'environment': environment(), 'generation': [], 'bank_size': []}
+    for coord_frame, distance_max, nhood_param, nhood_size in product(
+            opts.coord_frame, opts.distance_max, opts.neighborhood_param, opts.neighborhood_size):
+        if coord_frames[coord_frame].varying_metric and nhood_param in ('grid', 'kdtree'):
+            continue
+        if nhood_param in ('grid', 'kdtree') and nhood_size != opts.neighborhood_size[0]:
+            continue  # the same run again
+        case = {'coord_frame': coord_frame, 'distance_max': distance_max, 'neighborhood_param': nhood_param,
+                'neighborhood_size': nhood_size}
+        kwargs = dict(case, convergence_threshold=opts.convergence_threshold,
+                      max_new_templates=opts.max_new_templates, seed=opts.seed)
+        print("generation:", case, file=sys.stderr)
+        result = dict(case, **run_generation(**kwargs))
+        if not opts.no_memory:
+            result['peak_memory_mb'] = _peak_memory(run_generation, **kwargs)
+        results['generation'].append(result)
+
+        for bank_size in opts.bank_size:
+            print("bank size %d:" % bank_size, case, file=sys.stderr)
+            results['bank_size'].append(dict(case, bank_size=bank_size,
+                                             **run_bank_size(bank_size=bank_size, seed=opts.seed, **case)))
+
+    if opts.output_file:
+        with open(opts.output_file, 'w') as f:
+            json.dump(results, f, indent=1)
+    else:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+This code runs end-to-end checks of the tools built around the bank generation, type
+```shell
+python3 checks.py --help
+```
+in command line for further help docs.
+
+Each check prints what it measured and exits with a non-zero status if it fails, e.g.
+```shell
+python3 checks.py prune filterbank
+```
+The batch and resume checks run sbank.py itself, with several --proposal-batch-size, and interrupted
+ (killed) and resumed from its --checkpoint-file.
+The filterbank check requires pycbc, and fetches the data of GW150914 unless --synthetic is given.
+"""
+from optparse import OptionParser
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from filterbank import BankFilter, condition, estimate_psd, load_strain, synthetic_strain
+from prune import prune
+from sbank import generate_bank
+from verify import nearest_distances
+
+
+def check_prune(coord_frame='Cartesian', distance_max=0.05, n_injections=1000000, workers=1):
+    """
+    Merge two banks generated with different seeds, which makes many templates redundant, prune the merged bank
+     and check with verify.py that the pruned bank leaves no more injections uncovered than the merged one.
+    Return (merged size, pruned size, uncovered fraction before, after).
+    """
+    polar = coord_frame in ('Polar', 'PolarMetric')
+    options = dict(coord_frame=coord_frame, x1_min=0.2 if coord_frame == 'PolarMetric' else 0., x1_max=1.,
+                   x2_min=0., x2_max=np.pi / 2 if polar else 1., distance_max=distance_max)
+    merged = np.concatenate([generate_bank(seed=seed, **options).to_array() for seed in (1, 2)])
+    constraints = {'x1': (options['x1_min'], options['x1_max']), 'x2': (options['x2_min'], options['x2_max'])}
+    nhood_param = 'x1' if coord_frame == 'PolarMetric' else 'grid'
+    keep = prune(merged, coord_frame, constraints, distance_max, nhood_param, distance_max * 2, workers)
+
+    uncovered = []
+    for params in (merged, merged[keep]):
+        distances = nearest_distances(params, coord_frame, constraints, n_injections, 2 * distance_max,
+                                      nhood_param, 2 * distance_max, workers)
+        uncovered.append(np.count_nonzero(distances > distance_max) / n_injections)
+    return len(merged), int(keep.sum()), uncovered[0], uncovered[1]
+
+
+def _run_sbank(args, output_filename):
+    """Run sbank.py with the command line args (a list) and return the bank it writes to output_filename (.npy)."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sbank.py')
+    subprocess.run([sys.executable, script, *args, '--output-filename', output_filename], check=True,
+                   stdout=subprocess.DEVNULL, env=dict(os.environ, MPLBACKEND='Agg'))
+    return np.load(output_filename)
+
+
+def check_batch(coord_frame='Cartesian', distance_max=0.05, proposal_strategy='uniform', batch_sizes=(1, 64, 1024)):
+    """
+    Run sbank.py with each --proposal-batch-size of batch_sizes and compare the .npy files it writes with
+     the one of the first size, which must be the same bank.
+    Return (bank sizes, whether each file is equal to the first one).
+    """
+    polar = coord_frame in ('Polar', 'PolarMetric')
+    args = ['--coord-frame', coord_frame, '--x1-min', '0.2' if coord_frame == 'PolarMetric' else '0.',
+            '--x1-max', '1.', '--x2-min', '0.', '--x2-max', str(np.pi / 2 if polar else 1.),
+            '--distance-max', str(distance_max), '--proposal-strategy', proposal_strategy]
+    with tempfile.TemporaryDirectory() as tmp:
+        banks = [_run_sbank(args + ['--proposal-batch-size', str(size)], os.path.join(tmp, 'batch%d.npy' % size))
+                 for size in batch_sizes]
+    return [arr.shape[1] for arr in banks], [np.array_equal(arr, banks[0]) for arr in banks]
+
+
+def check_resume(distance_max=0.03, checkpoint_every=5000, seed=3):
+    """
+    Run sbank.py (Cartesian) with --checkpoint-file, kill it once it has written a checkpoint, resume it and
+     compare its bank with the one of an uninterrupted run; compare the banks of the grid and kdtree indices
+     with the one of the (x1) window index as well, as sets of templates since they are written in index order.
+    Return (bank size, the same after resuming, the same with grid, the same with kdtree).
+    """
+    args = ['--coord-frame', 'Cartesian', '--x1-min', '0.', '--x1-max', '1.', '--distance-max', str(distance_max),
+            '--seed', str(seed)]
+    with tempfile.TemporaryDirectory() as tmp:
+        full = _run_sbank(args, os.path.join(tmp, 'full.npy'))
+
+        checkpoint = os.path.join(tmp, 'run.ckpt')
+        run = args + ['--checkpoint-file', checkpoint, '--checkpoint-every', str(checkpoint_every)]
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sbank.py')
+        proc = subprocess.Popen([sys.executable, script, *run, '--output-filename', os.path.join(tmp, 'killed.npy')],
+                                stdout=subprocess.DEVNULL, env=dict(os.environ, MPLBACKEND='Agg'))
+        while not os.path.exists(checkpoint) and proc.poll() is None:
+            time.sleep(0.01)
+        proc.kill()
+        if proc.wait() == 0:
+            raise RuntimeError("sbank.py finished before it could be interrupted, lower checkpoint_every.")
+        resumed = _run_sbank(run + ['--resume'], os.path.join(tmp, 'resumed.npy'))
+
+        def rows(arr):
+            return arr[:, np.lexsort(arr)]
+
+        same_index = [np.array_equal(rows(_run_sbank(args + ['--neighborhood-param', param],
+                                                     os.path.join(tmp, param + '.npy'))), rows(full))
+                      for param in ('grid', 'kdtree')]
+    return full.shape[1], np.array_equal(resumed, full), same_index[0], same_index[1]
+
+
+def check_filterbank(synthetic=False, mass1=36., mass2=36., f_lower=20.):
+    """
+    Filter the data of matched_filtering.py (GW150914 in H1, or synthetic data) with its template of masses
+     (mass1, mass2), by pycbc.filter.matched_filter() as matched_filtering.py does and by BankFilter.peak_snrs().
+    Return (pycbc SNR, pycbc time, BankFilter SNR, BankFilter time, sample spacing) of the peaks.
+    """
+    from pycbc.filter import matched_filter
+    from pycbc.waveform import get_td_waveform
+    from pycbc.waveform.utils import taper_timeseries
+
+    strain = synthetic_strain(mass1, mass2)[0] if synthetic else load_strain()[0]
+    conditioned = condition(strain)
+    psd = estimate_psd(conditioned)
+
+    hp, _ = get_td_waveform(approximant="SEOBNRv4_opt", mass1=mass1, mass2=mass2,
+                            delta_t=conditioned.delta_t, f_lower=f_lower)
+    hp = taper_timeseries(hp, tapermethod='start')
+    hp.resize(len(conditioned))
+    template = hp.cyclic_time_shift(hp.start_time)
+    snr = matched_filter(template, conditioned, psd=psd, low_frequency_cutoff=f_lower).crop(4 + 4, 4)
+    peak = snr.abs_arg_max()
+
+    snrs, times = BankFilter(conditioned, psd, f_lower).peak_snrs([(mass1, mass2)])
+    return (float(abs(snr[peak])), float(snr.sample_times[peak]), float(snrs[0]), float(times[0]),
+            float(conditioned.delta_t))
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] prune|batch|resume|filterbank ...")
+    parser.add_option("--injections", type="int", metavar="N", default=1000000,
+                      help="Number of injections of the coverage checks. Default 1000000.")
+    parser.add_option("--workers", type="int", metavar="N", default=1,
+                      help="Number of processes. Default 1.")
+    parser.add_option("--synthetic", action="store_true", default=False,
+                      help="Filter Gaussian noise with an injected signal instead of the data of GW150914 in the filterbank check.")
+    parser.add_option("--snr-tolerance", type="float", metavar="FLOAT", default=1e-3,
+                      help="Largest relative difference of the peak SNRs in the filterbank check. Default 1e-3.")
+    opts, args = parser.parse_args()
+    checks = args or ['prune']
+    failed = False
+    for check in checks:
+        if check == 'prune':
+            for coord_frame in ('Cartesian', 'ScaledEuclidean', 'Polar', 'PolarMetric'):
+                n, kept, before, after = check_prune(coord_frame, n_injections=opts.injections, workers=opts.workers)
+                ok = after <= before
+                failed |= not ok
+                print("prune %s: kept %d of %d templates, uncovered injections %.4g%% -> %.4g%%: %s" %
+                      (coord_frame, kept, n, 100 * before, 100 * after, "ok" if ok else "FAILED"))
+        elif check == 'batch':
+            for coord_frame, strategy in (('Cartesian', 'uniform'), ('ScaledEuclidean', 'halton'),
+                                          ('PolarMetric', 'uniform'), ('Cartesian', 'adaptive')):
+                sizes, same = check_batch(coord_frame, proposal_strategy=strategy)
+                ok = all(same)
+                failed |= not ok
+                print("batch %s %s: %s templates with batch sizes 1, 64, 1024: %s" %
+                      (coord_frame, strategy, ', '.join(map(str, sizes)), "ok" if ok else "FAILED"))
+        elif check == 'resume':
+            n, resumed, grid, kdtree = check_resume()
+            ok = resumed and grid and kdtree
+            failed |= not ok
+            print("resume: %d templates, the same after resuming: %s, with grid: %s, with kdtree: %s: %s" %
+                  (n, resumed, grid, kdtree, "ok" if ok else "FAILED"))
+        elif check == 'filterbank':
+            snr, time, bank_snr, bank_time, delta_t = check_filterbank(opts.synthetic)
+            # the peak may move by a sample when the SNRs of neighbouring samples are within round-off
+            ok = abs(bank_snr - snr) <= opts.snr_tolerance * snr and abs(bank_time - time) <= delta_t
+            failed |= not ok
+            print("filterbank: pycbc SNR %.4f at %.4fs, BankFilter SNR %.4f at %.4fs: %s" %
+                  (snr, time, bank_snr, bank_time, "ok" if ok else "FAILED"))
+        else:
+            parser.error("unknown check %r." % check)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+This code provides an append-only log of what happens during bank generation (proposals, neighborhood windows,
+ compared pairs and accepted templates), cheap enough to be written on the hot path.
+The frames of --generate-full-plots are rendered from it afterwards, see render.py.
+
+The file starts with a line of JSON (the header, describing the run), followed by fixed-size binary records.
+"""
+import json
+
+import numpy as np
+
+# kinds of events; x1, x2 are the proposal for PROPOSAL, the bounds of the window along header['nhood_param']
+#  for WINDOW, the template compared with the last proposal for PAIR and the new template for ACCEPT
+PROPOSAL, WINDOW, PAIR, ACCEPT = range(4)
+event_dtype = np.dtype([('kind', 'u1'), ('n_prop', '<i8'), ('nmatch', '<i8'), ('size', '<i8'),
+                        ('x1', '<f8'), ('x2', '<f8')])
+
+
+class EventLog(object):
+    """Writer of an event log, the records are buffered in a structured array and written in blocks."""
+    __slots__ = ('file', '_buffer', '_size')
+
+    def __init__(self, filename, header, buffer_size=65536):
+        self.file = open(filename, 'wb')
+        self.file.write(json.dumps(header).encode() + b'\n')
+        self._buffer = np.zeros(buffer_size, dtype=event_dtype)
+        self._size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, kind, n_prop, nmatch, size, x1, x2):
+        if self._size == len(self._buffer):
+            self.flush()
+        self._buffer[self._size] = (kind, n_prop, nmatch, size, x1, x2)
+        self._size += 1
+
+    def extend(self, kind, n_prop, nmatch, size, params):
+        """Append one event of the same kind for each row of params, an (m, 2) array."""
+        params = np.reshape(params, (-1, 2))
+        if self._size + len(params) > len(self._buffer):
+            self.flush()
+        if len(params) > len(self._buffer):
+            self._buffer = np.zeros(len(params), dtype=event_dtype)
+        new = self._buffer[self._size:self._size+len(params)]
+        new['kind'], new['n_prop'], new['nmatch'], new['size'] = kind, n_prop, nmatch, size
+        new['x1'], new['x2'] = params.T
+        self._size += len(params)
+
+    def flush(self):
+        self._buffer[:self._size].tofile(self.file)
+        self._size = 0
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+def read_events(filename):
+    """Return (header, records) of the event log in filename, the records are memory-mapped."""
+    with open(filename, 'rb') as f:
+        header = json.loads(f.readline())
+        offset = f.tell()
+        # a truncated last record (of an interrupted run) is left out
+        n = (f.seek(0, 2) - offset) // event_dtype.itemsize
+    if not n:
+        return header, np.zeros(0, dtype=event_dtype)
+    return header, np.memmap(filename, dtype=event_dtype, mode='r', offset=offset, shape=(n,))
@@ -0,0 +1,281 @@
+"""
+This code runs the matched filtering of matched_filtering.py over a whole template bank, type
+```shell
+python3 filterbank.py --help
+```
+in command line for further help docs.
+
+The data and its PSD are conditioned once, and the weighted frequency series of the data (s~ / PSD) is kept.
+The waveforms of the templates are generated in batches (and cached), their correlations with the data are
+ computed together with one inverse FFT over the batch, and the peak SNR of each template is reported, e.g.
+```shell
+python3 filterbank.py test_cartisian.npy --mass-range 20 60 --synthetic --workers 4
+```
+The (x1, x2) of the bank are mapped linearly from their limits to (mass1, mass2) within --mass-range.
+With --synthetic, the data are Gaussian noise of the design Advanced LIGO PSD with an injected signal,
+ so that the filtering runs offline without fetching the data of the event.
+"""
+from functools import lru_cache
+from multiprocessing import Pool
+from optparse import OptionParser
+import json
+import os
+import sys
+
+import numpy as np
+
+import bankfile
+
+# the filter of a worker process, see _init_worker()
+_filter = None
+
+
+def load_strain(event="GW150914", ifo="H1"):
+    """Fetch the strain of an event from the catalog."""
+    from pycbc.catalog import Merger
+
+    merger = Merger(event)
+    return merger.strain(ifo), merger.time
+
+
+def synthetic_strain(mass1=36., mass2=36., distance=500., duration=32., merger_time=20., sample_rate=4096,
+                     approximant="SEOBNRv4_opt", seed=0):
+    """
+    Return (strain, merger_time): Gaussian noise of the design Advanced LIGO PSD with the signal of a
+     non-spinning binary at distance (in Mpc) injected so that it merges at merger_time (from the start).
+    """
+    from pycbc.noise import noise_from_psd
+    from pycbc.psd import aLIGOZeroDetHighPower
+    from pycbc.types import TimeSeries
+    from pycbc.waveform import get_td_waveform
+    from pycbc.waveform.utils import taper_timeseries
+
+    delta_t = 1.0 / sample_rate
+    n = int(duration * sample_rate)
+    psd = aLIGOZeroDetHighPower(n // 2 + 1, 1.0 / duration, 10.)
+    data = noise_from_psd(n, delta_t, psd, seed=seed).numpy().copy()
+
+    hp, _ = get_td_waveform(approximant=approximant, mass1=mass1, mass2=mass2, distance=distance,
+                            delta_t=delta_t, f_lower=15)
+    hp = taper_timeseries(hp, tapermethod='start')
+    # the merger of hp is at its time 0, i.e. at sample -start_time / delta_t
+    start = int(round(merger_time * sample_rate)) - int(round(-float(hp.start_time) / delta_t))
+    hp = hp.numpy()
+    lo, hi = max(start, 0), min(start + len(hp), n)
+    data[lo:hi] += hp[lo - start:hi - start]
+    return TimeSeries(data, delta_t=delta_t, epoch=0), merger_time
+
+
+def condition(strain, sample_rate=2048, highpass_frequency=15.0, crop=2):
+    """Highpass and downsample the strain, and crop the spikes which the filters leave at its boundaries."""
+    from pycbc.filter import resample_to_delta_t, highpass
+
+    strain = resample_to_delta_t(highpass(strain, highpass_frequency), 1.0 / sample_rate)
+    return strain.crop(crop, crop)
+
+
+def estimate_psd(conditioned, segment=4, low_frequency_cutoff=15):
+    """Estimate the PSD of the conditioned data by the Welch method, interpolated to its frequency resolution."""
+    from pycbc.psd import interpolate, inverse_spectrum_truncation
+
+    psd = interpolate(conditioned.psd(segment), conditioned.delta_f)
+    return inverse_spectrum_truncation(psd, int(segment * conditioned.sample_rate),
+                                       low_frequency_cutoff=low_frequency_cutoff)
+
+
+class BankFilter(object):
+    """
+    Matched filter of conditioned data against many templates, with the data and its PSD prepared once.
+    peak_snrs() gives the same SNR as pycbc.filter.matched_filter() for each template, over the data
+     without crop_start and crop_end seconds at its boundaries (see matched_filtering.py).
+    """
+    def __init__(self, conditioned, psd, f_lower=20., approximant="SEOBNRv4_opt", crop_start=8., crop_end=4.,
+                 batch_size=32, cache_size=1024):
+        self.delta_t = float(conditioned.delta_t)
+        self.start_time = float(conditioned.start_time)
+        self.length = n = len(conditioned)
+        self.f_lower = f_lower
+        self.approximant = approximant
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.delta_f = 1.0 / (n * self.delta_t)
+        # the band of the correlation, as pycbc.filter.get_cutoff_indices() without f_upper
+        self.kmin, self.kmax = int(f_lower / self.delta_f), (n + 1) // 2
+        self.crop = int(crop_start / self.delta_t), n - int(crop_end / self.delta_t)
+
+        band = slice(self.kmin, self.kmax)
+        stilde = conditioned.to_frequencyseries().numpy()
+        self._inv_psd = 1.0 / np.asarray(psd.numpy()[band], dtype=float)
+        self._weighted = stilde[band] * self._inv_psd
+        self._init_cache()
+
+    def _init_cache(self):
+        self.template = lru_cache(maxsize=self.cache_size)(self._generate)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['template']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
+
+    def _generate(self, mass1, mass2):
+        """Return the frequency series of a template in the band, with its merger at the first sample."""
+        from pycbc.waveform import get_td_waveform
+        from pycbc.waveform.utils import taper_timeseries
+
+        hp, _ = get_td_waveform(approximant=self.approximant, mass1=mass1, mass2=mass2,
+                                delta_t=self.delta_t, f_lower=self.f_lower)
+        hp = taper_timeseries(hp, tapermethod='start')
+        hp.resize(self.length)
+        htilde = hp.cyclic_time_shift(hp.start_time).to_frequencyseries().numpy()[self.kmin:self.kmax]
+        htilde.flags.writeable = False
+        return htilde
+
+    def snr_batch(self, masses):
+        """Return the complex SNR time series of the templates of masses, (mass1, mass2) pairs, as rows."""
+        htilde = np.array([self.template(float(m1), float(m2)) for m1, m2 in masses])
+        sigmasq = 4 * self.delta_f * np.sum((htilde.real ** 2 + htilde.imag ** 2) * self._inv_psd, axis=1)
+        qtilde = np.zeros((len(htilde), self.length), dtype=complex)
+        qtilde[:, self.kmin:self.kmax] = htilde.conj() * self._weighted
+        # numpy's inverse FFT is normalized by 1 / length, pycbc's is not
+        q = np.fft.ifft(qtilde, axis=1) * self.length
+        return q * (4 * self.delta_f / np.sqrt(sigmasq))[:, None]
+
+    def peak_snrs(self, masses):
+        """
+        Return (snrs, times): the peak of |SNR| of each template of masses and the time of its merger,
+         filtering the templates batch_size at a time.
+        """
+        masses = np.asarray(masses, dtype=float).reshape(-1, 2)
+        snrs, times = np.empty(len(masses)), np.empty(len(masses))
+        lo, hi = self.crop
+        for start in range(0, len(masses), self.batch_size):
+            stop = start + self.batch_size
+            snr = np.abs(self.snr_batch(masses[start:stop])[:, lo:hi])
+            peak = np.argmax(snr, axis=1)
+            snrs[start:stop] = snr[np.arange(len(peak)), peak]
+            times[start:stop] = self.start_time + (lo + peak) * self.delta_t
+        return snrs, times
+
+
+def _init_worker(bank_filter):
+    global _filter
+    _filter = bank_filter
+
+
+def _filter_chunk(masses):
+    return _filter.peak_snrs(masses)
+
+
+def filter_bank(bank_filter, masses, workers=1, chunk_size=256):
+    """
+    Return (snrs, times), the peak SNR of each template of masses (an (n, 2) array of (mass1, mass2)) and its time,
+     filtering chunks of chunk_size templates in worker processes if workers > 1.
+    """
+    masses = np.asarray(masses, dtype=float).reshape(-1, 2)
+    if workers == 1:
+        return bank_filter.peak_snrs(masses)
+    chunks = [masses[i:i+chunk_size] for i in range(0, len(masses), chunk_size)]
+    with Pool(workers, _init_worker, (bank_filter,)) as pool:
+        results = pool.map(_filter_chunk, chunks)
+    if not results:
+        return np.empty(0), np.empty(0)
+    return np.concatenate([s for s, _ in results]), np.concatenate([t for _, t in results])
+
+
+def bank_masses(params, limits, mass_range):
+    """Map the (x1, x2) of the templates linearly from limits, ((x1_min, x1_max), (x2_min, x2_max)), to mass_range."""
+    params = np.asarray(params, dtype=float)
+    lo, hi = np.asarray(limits, dtype=float).T
+    m_min, m_max = mass_range
+    return m_min + (m_max - m_min) * (params - lo) / (hi - lo)
+
+
+def parse_command_line():
+    parser = OptionParser(usage="%prog [options] BANK")
+    for opt in ("x1-min", "x1-max", "x2-min", "x2-max"):
+        parser.add_option("--" + opt, type="float", metavar="FLOAT",
+                          help="Limit of the parameter space, mapped to the limits of --mass-range. Default: the one in the header of a bank file, else the extent of the bank.")
+    parser.add_option("--mass-range", type="float", nargs=2, metavar="MIN MAX", default=(10., 80.),
+                      help="Component masses (in solar masses) which x1 and x2 are mapped to. Default 10 80.")
+    parser.add_option("--event", default="GW150914",
+                      help="Event whose data are filtered. Default GW150914.")
+    parser.add_option("--ifo", default="H1",
+                      help="Detector whose data are filtered. Default H1.")
+    parser.add_option("--synthetic", action="store_true", default=False,
+                      help="Filter Gaussian noise with an injected signal instead of the data of --event.")
+    parser.add_option("--injection-masses", type="float", nargs=2, metavar="M1 M2", default=(36., 36.),
+                      help="Masses of the signal injected with --synthetic. Default 36 36.")
+    parser.add_option("--injection-distance", type="float", metavar="MPC", default=500.,
+                      help="Distance of the signal injected with --synthetic. Default 500.")
+    parser.add_option("--seed", type="int", metavar="INT", default=0,
+                      help="Seed of the noise of --synthetic.")
+    parser.add_option("--approximant", default="SEOBNRv4_opt",
+                      help="Waveform approximant of the templates. Default SEOBNRv4_opt.")
+    parser.add_option("--f-lower", type="float", metavar="HZ", default=20.,
+                      help="Low frequency cutoff of the templates and of the filter. Default 20.")
+    parser.add_option("--batch-size", type="int", metavar="N", default=32,
+                      help="Number of templates correlated together. Default 32.")
+    parser.add_option("--cache-size", type="int", metavar="N", default=1024,
+                      help="Number of template waveforms cached by each process. Default 1024.")
+    parser.add_option("--workers", type="int", metavar="N", default=1,
+                      help="Filter the chunks of the bank in N processes. Default 1.")
+    parser.add_option("--output-file", metavar="FILE", default=None,
+                      help="Write the results as JSON to FILE instead of the standard output.")
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("exactly one bank is required.")
+    if opts.workers < 1 or opts.batch_size < 1 or opts.cache_size < 1:
+        parser.error("--workers, --batch-size and --cache-size must be positive integers.")
+    return opts, args
+
+
+def main():
+    opts, args = parse_command_line()
+    params, header = bankfile.load_params(args[0])
+    # the masses are given by the first two parameters
+    params = np.asarray(params, dtype=float)[:, :2]
+    limits = []
+    for i, x in enumerate(("x1", "x2")):
+        lo, hi = (getattr(opts, x + suffix) for suffix in ("_min", "_max"))
+        lo = header.get(x + "_min") if lo is None else lo
+        hi = header.get(x + "_max") if hi is None else hi
+        limits.append((params[:, i].min() if lo is None else lo, params[:, i].max() if hi is None else hi))
+    masses = bank_masses(params, limits, opts.mass_range)
+
+    if opts.synthetic:
+        strain, merger_time = synthetic_strain(*opts.injection_masses, distance=opts.injection_distance,
+                                               approximant=opts.approximant, seed=opts.seed)
+    else:
+        strain, merger_time = load_strain(opts.event, opts.ifo)
+    conditioned = condition(strain)
+    psd = estimate_psd(conditioned)
+    bank_filter = BankFilter(conditioned, psd, opts.f_lower, opts.approximant,
+                             batch_size=opts.batch_size, cache_size=opts.cache_size)
+    snrs, times = filter_bank(bank_filter, masses, opts.workers)
+
+    best = int(np.argmax(snrs)) if len(snrs) else None
+    result = {'bank': os.path.abspath(args[0]), 'templates': len(masses),
+              'data': 'synthetic' if opts.synthetic else '%s:%s' % (opts.event, opts.ifo),
+              'merger_time': float(merger_time),
+              'best': None if best is None else {'template': best, 'mass1': float(masses[best, 0]),
+                                                 'mass2': float(masses[best, 1]), 'snr': float(snrs[best]),
+                                                 'time': float(times[best])},
+              'mass1': masses[:, 0].tolist(), 'mass2': masses[:, 1].tolist(),
+              'snr': snrs.tolist(), 'time': times.tolist()}
+    if opts.output_file:
+        with open(opts.output_file, 'w') as f:
+            json.dump(result, f, indent=1)
+    else:
+        json.dump(result, sys.stdout, indent=1)
+        print()
+    if best is not None:
+        print("the best of %d templates, (%.2f, %.2f), found SNR %.2f at %.2fs." %
+              (len(masses), masses[best, 0], masses[best, 1], snrs[best], times[best]), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""
+This code removes redundant templates from a finished bank, type
+```shell
+python3 prune.py --help
+```
+in command line for further help docs.
+
+A template is redundant if every point of its region (within distance_max of it, and within the constraints)
+ stays within distance_max of the other templates. The region is sampled by test points on a square lattice
+ of the coordinates whitened by the metric of the template, with a spacing such that every point of the region
+ lies within slack * distance_max of a test point (lattice points outside the constraints are moved onto
+ their boundary). A test point is counted as covered by each other template within (1 - slack) * distance_max
+ of it, so that a template whose test points are all covered by others has its whole region covered.
+These pairs are found through a neighborhood index of the bank, in chunks of the sorted neighborhood order
+ (in parallel processes with --workers). The templates are then visited in the sorted order once, and a template
+ is removed if its test points, and those of the templates removed before it which it covers, are still covered
+ by another template. Hence the pruning never uncovers any point that the bank covered, which verify.py confirms.
+This holds exactly for a constant diagonal metric, and approximately for the others.
+
+Note that a bank made by sbank.py alone has no redundant template, since each template was farther than
+ distance_max from all the others when it was accepted; the redundant ones come from merging banks,
+ e.g. with --bank-seed, or from generating overlapping regions separately.
+"""
+from multiprocessing import Pool
+from optparse import OptionParser
+import os
+import sys
+
+import numpy as np
+
+from bank import Bank
+import bankfile
+from templates import coord_frames
+import verify
+from verify import _init_worker, add_bank_options, fill_options
+
+def test_offsets(coeffs, max_distance, slack=0.1):
+    """
+    Return the offsets of the test points of templates whose metric coefficients are the rows of coeffs (see
+     BasicTemplate.coeffs_at()) as an (m, k, 2) array: the points of a square lattice in the coordinates whitened
+     by the metric, with a spacing of sqrt(2) * slack * max_distance, whose cells meet the ellipse at max_distance.
+    Every point of the ellipse then lies within slack * max_distance of a test point.
+    """
+    spacing = np.sqrt(2) * slack * max_distance
+    n = int(np.ceil((1 + slack) * max_distance / spacing))
+    w = np.stack(np.meshgrid(*2 * [spacing * np.arange(-n, n + 1)], indexing='ij'), axis=-1).reshape(-1, 2)
+    w = w[np.hypot(w[:, 0], w[:, 1]) <= (1 + slack) * max_distance]
+    # metric = L L^T with L = [[l11, 0], [l21, l22]], the offsets dx solve dx L = w
+    a, b, c = np.asarray(coeffs, dtype=float).T
+    l11 = np.sqrt(a)
+    l21 = b / (2 * l11)
+    l22 = np.sqrt(c - l21 * l21)
+    dx2 = w[None, :, 1] / l22[:, None]
+    dx1 = (w[None, :, 0] - dx2 * l21[:, None]) / l11[:, None]
+    return np.stack((dx1, dx2), axis=-1)
+
+
+def clip(coord_frame, points, constraints):
+    """Return points (template parameters as an (m, 2) array) moved onto the nearest point within the constraints."""
+    (x1_min, x1_max), (x2_min, x2_max) = constraints['x1'], constraints['x2']
+    if coord_frame == 'Polar':
+        # the templates are placed in Cartesian coordinates, the constraints are on (r, theta)
+        r = np.clip(np.hypot(points[:, 0], points[:, 1]), x1_min, x1_max)
+        theta = np.clip(np.arctan2(points[:, 1], points[:, 0]) % (2 * np.pi), x2_min, x2_max)
+        return np.column_stack((r * np.cos(theta), r * np.sin(theta)))
+    return np.column_stack((np.clip(points[:, 0], x1_min, x1_max), np.clip(points[:, 1], x2_min, x2_max)))
+
+
+def _covering_pairs(args):
+    """
+    Return (points, rows): the test points of the templates in rows_ (numbered row * k + i) paired with
+     the other templates covering them, within (1 - slack) * max_distance.
+    """
+    rows_, coord_frame, constraints, max_distance, slack = args
+    # the bank of the worker process, see verify._init_worker()
+    bank = verify._bank
+    params = bank.rows()[rows_]
+    offsets = test_offsets(bank.tmplt_class.coeffs_at(params), max_distance, slack)
+    k = offsets.shape[1]
+    points = clip(coord_frame, (params[:, None, :] + offsets).reshape(-1, 2), constraints)
+    ids = (rows_[:, None] * k + np.arange(k)).ravel()
+
+    reach = (1 - slack) * max_distance
+    point_ids, covering = [np.empty(0, dtype=np.intp)], [np.empty(0, dtype=np.intp)]
+    for prop_idx, rows, distances in bank.pairs(points, reach):
+        hit = (distances < reach) & (rows != ids[prop_idx] // k)
+        point_ids.append(ids[prop_idx[hit]])
+        covering.append(rows[hit])
+    return np.concatenate(point_ids), np.concatenate(covering), k
+
+
+def prune(params, coord_frame, constraints, max_distance, nhood_param='grid', nhood_size=None, workers=1,
+          slack=0.1, chunk_size=1024):
+    """
+    Return a boolean array telling which templates of params (an (n, 2) array) are kept by the pruning,
+     see the module documentation; slack sets the test points of each template (see test_offsets()).
+    """
+    tmplt_class = coord_frames[coord_frame]
+    if nhood_param == 'grid':
+        nhood_size = max_distance * np.sqrt(max(tmplt_class.vals))
+    elif nhood_size is None:
+        nhood_size = max_distance * max(tmplt_class.half_axes)
+    n = len(params)
+    init_args = (params, tmplt_class, nhood_param, nhood_size)
+    _init_worker(*init_args)
+    order = verify._bank.order()
+    # chunks of the sorted order hold nearby templates, which share their candidates
+    tasks = [(order[i:i+chunk_size], coord_frame, constraints, max_distance, slack)
+             for i in range(0, n, chunk_size)]
+    if workers == 1:
+        results = list(map(_covering_pairs, tasks))
+    else:
+        with Pool(workers, _init_worker, init_args) as pool:
+            results = pool.map(_covering_pairs, tasks)
+    if not results:
+        return np.ones(0, dtype=bool)
+    k = results[0][2]
+    point_ids = np.concatenate([p for p, _, _ in results])
+    covering = np.concatenate([r for _, r, _ in results])
+
+    # the number of kept templates (other than its own) covering each test point
+    count = np.bincount(point_ids, minlength=n * k)
+    # the test points covered by each template
+    perm = np.argsort(covering, kind='stable')
+    point_ids = point_ids[perm]
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(covering, minlength=n)))).tolist()
+
+    keep = np.ones(n, dtype=bool)
+    for row in order.tolist():
+        if count[row * k:(row + 1) * k].min() < 1:
+            continue
+        covered = point_ids[bounds[row]:bounds[row+1]]
+        # the points of the removed templates must stay covered by another one
+        removed = covered[~keep[covered // k]]
+        if len(removed) and count[removed].min() < 2:
+            continue
+        count[covered] -= 1
+        keep[row] = False
+    return keep
+
+
+def parse_command_line():
+    parser = OptionParser(usage="%prog [options] BANK")
+    add_bank_options(parser)
+    parser.add_option("--neighborhood-size", type="float", metavar="FLOAT", default=None,
+                      help="Window of the x1, x2 and norm indices. Default: --distance-max times the largest half axis of the ellipses.")
+    parser.add_option("--slack", type="float", metavar="FLOAT", default=0.1,
+                      help="Spacing of the test points in units of --distance-max (see the module documentation), a smaller slack removes more templates but takes longer, as there are about 2 / slack^2 test points per template. Default 0.1.")
+    parser.add_option("--workers", type="int", metavar="N", default=1,
+                      help="Find the covering templates of the chunks of the bank in N processes. Default 1.")
+    parser.add_option("--output-filename", metavar="FILE", default=None,
+                      help="Required. Name for the pruned bank, a bank file if it ends with .bank, else a .npy array of shape (2, n).")
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("exactly one bank is required.")
+    if opts.output_filename is None:
+        parser.error("--output-filename is required")
+    if os.path.abspath(opts.output_filename) == os.path.abspath(args[0]):
+        parser.error("the pruned bank would overwrite the input bank, choose a different output name.")
+    if opts.workers < 1:
+        parser.error("--workers must be a positive integer.")
+    if not 0 < opts.slack < 1:
+        parser.error("--slack must be between 0 and 1.")
+    return opts, args
+
+
+def main():
+    opts, args = parse_command_line()
+    params, header = bankfile.load_params(args[0])
+    tmplt_class, nhood_param = fill_options(opts, header)
+    if tmplt_class.ndim != 2:
+        sys.exit("prune.py only handles banks of two dimensions, --coord-frame %s has %d." %
+                 (opts.coord_frame, tmplt_class.ndim))
+    constraints = {'x1': (opts.x1_min, opts.x1_max), 'x2': (opts.x2_min, opts.x2_max)}
+    keep = prune(params, opts.coord_frame, constraints, opts.distance_max, nhood_param, opts.neighborhood_size,
+                 opts.workers, opts.slack)
+
+    pruned = np.asarray(params)[keep]
+    if opts.output_filename.endswith(bankfile.extension):
+        metadata = {key: value for key, value in header.items() if key not in ('rows', 'order')}
+        metadata.update(coord_frame=opts.coord_frame, distance_max=opts.distance_max, pruned_from=len(params))
+        bank = Bank.from_array(pruned, tmplt_class, header.get('neighborhood_size', 0.25),
+                               header.get('neighborhood_param', 'x1'))
+        bankfile.write_bank(opts.output_filename, bank, **metadata)
+    else:
+        np.save(opts.output_filename, pruned.T)
+    print("removed %d of %d templates, %d are left." % (len(params) - len(pruned), len(params), len(pruned)),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""
+This code turns the event log of a run (see eventlog.py) into the frames of --generate-full-plots, type
+```shell
+python3 render.py --help
+```
+in command line for further help docs.
+
+The frames are split into contiguous ranges rendered by worker processes. Each worker keeps the templates
+ accepted before the current frame in a cached background, to which it adds the templates accepted since the
+ last frame (also those whose frames are skipped by --stride), and only draws what changes on top of it for each
+ frame. The templates are added one by one, so that a frame is the same whatever the ranges and the stride.
+The frames can then be combined into a video, e.g.
+```shell
+ffmpeg -framerate 30 -pattern_type glob -i 'fig_test/*.png' -pix_fmt yuv420p test.mp4
+```
+"""
+from multiprocessing import Pool
+from optparse import OptionParser
+import os
+
+import numpy as np
+
+from eventlog import ACCEPT, PAIR, PROPOSAL, WINDOW, read_events
+from templates import coord_frames
+
+# stages of a proposal shown by the frames, in this order (the last two for accepted proposals only)
+SHOW_PROPOSAL, SHOW_PAIRS, SHOW_NEW, SHOW_ACCEPTED = range(4)
+
+
+def frame_list(records, only_accepted=False):
+    """
+    Return the frames of a run as two arrays (at, stage): each frame shows the state after the record at
+     and the stage of the proposal. With only_accepted, the frames of rejected proposals are left out.
+    """
+    kind = np.asarray(records['kind'])
+    proposal = np.flatnonzero(kind == PROPOSAL)
+    # the last pair of each proposal
+    pair = np.flatnonzero((kind == PAIR) & (np.append(kind[1:], PROPOSAL) != PAIR))
+    accept = np.flatnonzero(kind == ACCEPT)
+    at = np.concatenate((proposal, pair, accept, accept))
+    stage = np.repeat([SHOW_PROPOSAL, SHOW_PAIRS, SHOW_NEW, SHOW_ACCEPTED],
+                      [len(proposal), len(pair), len(accept), len(accept)])
+    order = np.lexsort((stage, at))
+    at, stage = at[order], stage[order]
+    if only_accepted:
+        keep = np.isin(np.asarray(records['n_prop'])[at], np.asarray(records['n_prop'])[accept])
+        at, stage = at[keep], stage[keep]
+    return at, stage
+
+
+def frame_name(record, stage):
+    """File name of a frame, wide enough to sort the frames in order for long runs."""
+    suffix = {SHOW_NEW: '_0', SHOW_ACCEPTED: '_1'}.get(stage, '')
+    return f"{record['n_prop']:0>7d}_{record['nmatch']:0>9d}_{record['size']:0>5d}{suffix}.png"
+
+
+def _new_figure():
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(6, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.set_xlabel('x', fontsize=24)
+    ax.set_ylabel('y', fontsize=24)
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1)  # TODO: improve these hard-coded settings
+    ax.tick_params(labelsize=16)
+    ax.grid(which='both', zorder=1, alpha=0.5)
+    ax.set_aspect('equal')
+    fig.tight_layout()
+    return fig, ax
+
+
+def _render_range(args):
+    """Render the frames (at, stage) of the event log in filename to out_dir, return the number of frames."""
+    from matplotlib.collections import LineCollection
+    from matplotlib.lines import Line2D
+    from matplotlib.patches import Ellipse
+    from PIL import Image
+
+    filename, at, stage, out_dir = args
+    header, records = read_events(filename)
+    tmplt_class = coord_frames[header['coord_frame']]
+    max_distance = header['distance_max']
+    kind = np.asarray(records['kind'])
+    proposals = np.flatnonzero(kind == PROPOSAL)
+    accepted = np.flatnonzero(kind == ACCEPT)
+
+    fig, ax = _new_figure()
+    canvas = fig.canvas
+
+    def params(rows):
+        return np.column_stack((records['x1'][rows], records['x2'][rows]))
+
+    def template(row, color):
+        """Return the artists of a template (ellipse and dot) at the point of a record."""
+        points = params([row])
+        w, h, ang = tmplt_class.ellipses(points, max_distance)
+        ellipse = Ellipse(points[0], width=w[0], height=h[0], angle=ang[0], color=color, alpha=0.2)
+        dots = Line2D(points[:, 0], points[:, 1], ls='', markersize=1, color=color, marker='.', zorder=3)
+        return [ellipse, dots]
+
+    def draw(artists):
+        for artist in artists:
+            ax.add_artist(artist)
+            ax.draw_artist(artist)
+            artist.remove()
+
+    # the background holds the templates accepted before the current frame, drawn one by one as the
+    # frames of a full render do, which keeps the frames the same whatever the ranges and the stride
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+    n_done = 0
+
+    for i, s in zip(at.tolist(), stage.tolist()):
+        canvas.restore_region(background)
+        n_before = np.searchsorted(accepted, i)
+        if n_before > n_done:
+            for row in accepted[n_done:n_before].tolist():
+                draw(template(row, 'C0'))
+            background = canvas.copy_from_bbox(fig.bbox)
+            n_done = n_before
+        if s in (SHOW_PROPOSAL, SHOW_PAIRS):
+            p = proposals[np.searchsorted(proposals, i, side='right') - 1]
+            x1, x2 = records['x1'][p], records['x2'][p]
+            artists = template(p, 'C3')
+            if p + 1 < len(records) and kind[p+1] == WINDOW:
+                span = ax.axvspan if header['nhood_param'] == 'x1' else ax.axhspan
+                window = span(records['x1'][p+1], records['x2'][p+1], lw=0, color='C1', alpha=0.2, zorder=2)
+                window.remove()
+                artists.insert(0, window)
+            if s == SHOW_PAIRS:
+                pairs = params(np.arange(p + 1, i + 1)[kind[p+1:i+1] == PAIR])
+                segments = np.stack((np.broadcast_to((x1, x2), pairs.shape), pairs), axis=1)
+                artists.append(LineCollection(segments, colors='C4', lw=1, zorder=3))
+            draw(artists)
+        else:
+            draw(template(i, 'C2' if s == SHOW_NEW else 'C0'))
+        # the figure is opaque, and encoding the PNG takes most of the time, so drop the alpha channel
+        rgb = np.asarray(canvas.buffer_rgba())[:, :, :3]
+        Image.fromarray(np.ascontiguousarray(rgb)).save(os.path.join(out_dir, frame_name(records[i], s)),
+                                                        compress_level=1)
+        if s == SHOW_ACCEPTED:
+            # the new template becomes part of the background
+            background = canvas.copy_from_bbox(fig.bbox)
+            n_done = np.searchsorted(accepted, i, side='right')
+    return len(at)
+
+
+def render_frames(filename, out_dir, workers=None, only_accepted=False, stride=1):
+    """
+    Render the frames of the event log in filename to out_dir in parallel worker processes
+     (os.cpu_count() by default), keeping every stride-th frame only. Return the number of frames.
+    """
+    _, records = read_events(filename)
+    at, stage = (i[::stride] for i in frame_list(records, only_accepted))
+    workers = workers or os.cpu_count()
+    # several ranges per worker, which balances the load
+    ranges = [r for r in np.array_split(np.arange(len(at)), 4 * workers) if len(r)]
+    tasks = [(filename, at[r], stage[r], out_dir) for r in ranges]
+    if workers == 1:
+        return sum(map(_render_range, tasks))
+    with Pool(workers) as pool:
+        return sum(pool.imap_unordered(_render_range, tasks))
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] EVENT_LOG")
+    parser.add_option("--output-dir", metavar="DIR",
+                      help="Required. Directory to write the frames to, it is created if needed.")
+    parser.add_option("--workers", type="int", metavar="N", default=None,
+                      help="Render the frames in N processes. Default: the number of CPUs.")
+    parser.add_option("--only-accepted", action="store_true", default=False,
+                      help="Only render the frames of the accepted proposals.")
+    parser.add_option("--stride", type="int", metavar="N", default=1,
+                      help="Only render every N-th frame. Default 1.")
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("exactly one event log is required.")
+    if opts.output_dir is None:
+        parser.error("--output-dir is required")
+    if opts.stride < 1 or (opts.workers is not None and opts.workers < 1):
+        parser.error("--stride and --workers must be positive integers.")
+
+    os.makedirs(opts.output_dir, exist_ok=True)
+    n_frames = render_frames(args[0], opts.output_dir, opts.workers, opts.only_accepted, opts.stride)
+    print("rendered %d frames to %s" % (n_frames, opts.output_dir))
+
+
+if __name__ == '__main__':
+    main()
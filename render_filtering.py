@@ -0,0 +1,123 @@
+"""
+This code renders the frames of the matched-filtering animation of matched_filtering.py.
+
+Each frame shifts the whitened template by a step in time over the whitened data and shows the SNR up to the
+ shifted time. The shifted windows of the template and the ends of the SNR prefixes are computed for all the
+ frames at once, and the frames are split into contiguous ranges rendered by worker processes, each of which
+ draws the data once and only updates the SNR and template lines for each frame.
+The frames are written as PNGs, or piped in order into a single ffmpeg process which encodes the video.
+"""
+from multiprocessing import Pool
+import os
+import subprocess
+
+import numpy as np
+
+
+def frame_windows(snr_times, times, time, shifts, xlim):
+    """
+    Return (snr_lo, snr_hi, lo, hi) for the template shifted by each of shifts: the SNR before time + shift
+     (as bisect_right over snr_times) which lies within xlim, and the template samples at times (before the
+     shift) which the shift moves within xlim, padded with a sample on each side so that the lines reach the edges.
+    """
+    shifts = np.asarray(shifts, dtype=float)
+    snr_lo = max(np.searchsorted(snr_times, xlim[0], side='right') - 1, 0)
+    snr_hi = np.searchsorted(snr_times, time + shifts, side='right')
+    lo = np.maximum(np.searchsorted(times, xlim[0] - shifts, side='right') - 1, 0)
+    hi = np.minimum(np.searchsorted(times, xlim[1] - shifts, side='left') + 1, len(times))
+    return np.full(len(shifts), snr_lo), snr_hi, lo, hi
+
+
+def _new_figure(times, data, xlim, ylim):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(12, 5))
+    FigureCanvasAgg(fig)
+    ax1, ax2 = fig.subplots(2, 1, sharex='col')
+    ax1.set_ylim(*ylim)
+    ax1.set_ylabel('Signal-to-Noise Ratio')
+    # only the data within the window are drawn
+    lo = max(np.searchsorted(times, xlim[0]) - 1, 0)
+    hi = np.searchsorted(times, xlim[1]) + 1
+    ax2.plot(times[lo:hi], data[lo:hi], color='steelblue', lw=1, label="Data")
+    ax2.set_xlim(*xlim)
+    ax2.set_xlabel('Time (s)')
+    ax2.set_ylabel('Whitened Strain')
+    snr_line, = ax1.plot([], [], color='darkblue', lw=1)
+    template_line, = ax2.plot([], [], color='darkorange', lw=1, label="Template")
+    ax2.legend(loc='upper right')
+    return fig, snr_line, template_line
+
+
+def _render_range(args):
+    """
+    Render the frames of a range, return their RGB pixels as a list of bytes if out_dir is None,
+     else write them to out_dir and return their number.
+    """
+    from PIL import Image
+
+    (frames, shifts, windows, snr_times, snr, times, data, template, xlim, ylim, out_dir) = args
+    fig, snr_line, template_line = _new_figure(times, data, xlim, ylim)
+    pixels = []
+    for i, shift, (snr_lo, snr_hi, lo, hi) in zip(frames.tolist(), shifts.tolist(), windows.tolist()):
+        snr_line.set_data(snr_times[snr_lo:snr_hi], snr[snr_lo:snr_hi])
+        template_line.set_data(times[lo:hi] + shift, template[lo:hi])
+        fig.canvas.draw()
+        # the figure is opaque, so drop the alpha channel
+        rgb = np.ascontiguousarray(np.asarray(fig.canvas.buffer_rgba())[:, :, :3])
+        if out_dir is None:
+            pixels.append(rgb.tobytes())
+        else:
+            Image.fromarray(rgb).save(os.path.join(out_dir, f'AlignedWaveform_{i:0>3d}.png'), compress_level=1)
+    return pixels if out_dir is None else len(frames)
+
+
+def render_animation(snr_times, snr, times, data, template, time, xlim, out_dir='fig_matched_filtering',
+                     n_frames=321, start=-0.8, step=0.005, ylim=(0, 20), workers=None, video=None, framerate=30):
+    """
+    Render the frames of the template (whitened, sampled at times as the data) shifted from time + start by step,
+     over the whitened data and the SNR (abs, at snr_times), in worker processes (os.cpu_count() by default).
+    The frames are written as PNGs to out_dir, or encoded by ffmpeg into the file video if it is given.
+    Return the number of frames.
+    """
+    snr_times, snr, times, data, template = (np.asarray(i, dtype=float)
+                                              for i in (snr_times, snr, times, data, template))
+    frames = np.arange(n_frames)
+    shifts = start + step * frames
+    windows = np.column_stack(frame_windows(snr_times, times, time, shifts, xlim))
+    workers = workers or os.cpu_count()
+    if video is None:
+        os.makedirs(out_dir, exist_ok=True)
+        # several ranges per worker, which balances the load
+        n_ranges = 4 * workers
+    else:
+        out_dir = None
+        # the frames of a range are held in memory until they are piped in order
+        n_ranges = max(4 * workers, n_frames // 16)
+    tasks = [(frames[r], shifts[r], windows[r], snr_times, snr, times, data, template, xlim, ylim, out_dir)
+             for r in np.array_split(np.arange(n_frames), n_ranges) if len(r)]
+
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        if video is None:
+            return sum(pool.imap_unordered(_render_range, tasks) if pool else map(_render_range, tasks))
+        fig = _new_figure(times, data, xlim, ylim)[0]
+        width, height = fig.canvas.get_width_height()
+        encoder = subprocess.Popen(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                                    '-s', f'{width}x{height}', '-framerate', str(framerate), '-i', '-',
+                                    '-pix_fmt', 'yuv420p', video], stdin=subprocess.PIPE)
+        try:
+            for pixels in (pool.imap(_render_range, tasks) if pool else map(_render_range, tasks)):
+                for frame in pixels:
+                    encoder.stdin.write(frame)
+        finally:
+            encoder.stdin.close()
+            encoder.wait()
+        if encoder.returncode:
+            raise RuntimeError("ffmpeg failed with exit code %d" % encoder.returncode)
+        return n_frames
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
@@ -10,26 +10,38 @@ NOTE: It'd better set an environment variable: (Do this before import numpy!)
 >>>os.environ["OMP_NUM_THREADS"] = "1"  # a better way than os.system("export OMP_NUM_THREADS=1")
 In pycharm you can set OMP_NUM_THREADS=1 in [run/debug configurations]
 (Run - Edit configurations... or in the upper right toolbar)
+To use several cores, run with --workers N instead, which generates N strips of the bank in parallel processes.
+
+The generation can be run in-process as well, with the same options as the command line (underscored):
+>>>from sbank import generate_bank, iter_templates
+>>>bank = generate_bank(coord_frame='Cartesian', x1_min=0., x1_max=1., distance_max=0.1)
+>>>for tmplt in iter_templates(coord_frame='Cartesian', x1_min=0., x1_max=1., max_new_templates=10): ...
+matplotlib is only imported when plotting.
 """
 from collections import deque
+from copy import copy
+from multiprocessing import Pool
 from optparse import OptionParser
 from time import strftime
+import cProfile
+import json
 import os
 
 import numpy as np
 
-from bank import Bank
-from templates import coord_frames, proposals
-
-import matplotlib.pyplot as plt
-from matplotlib.collections import EllipseCollection
+from bank import Bank, nhood_indices
+import bankfile
+from eventlog import EventLog
+from render import render_frames
+from stats import RunStats, phases
+from templates import OccupancyGrid, coord_frames, max_ndim, proposal_chunks, samplers
 
 
-def parse_command_line():
+def _option_parser():
     parser = OptionParser()
     # coord_frames parameter options
     parser.add_option("--coord-frame", choices=list(coord_frames.keys()), metavar='|'.join(coord_frames.keys()),
-                      help="Required. Specify the coord_frames to use for template generation.")
+                      help="Required. Specify the coord_frames to use for template generation. \"Polar\" draws (r, theta) and places the templates in Cartesian coordinates, while \"PolarMetric\" places them in (r, theta) with the position-dependent metric dr^2 + r^2 dtheta^2. \"Cartesian3D\" to \"Cartesian6D\" are Euclidean spaces of 3 to 6 dimensions, limited by --x3-min/--x3-max and so on.")
     parser.add_option("--x1-min", type="float", metavar="FLOAT",
                       help="Required. Set minimum x of the first axis.")
     parser.add_option("--x1-max", type="float", metavar="FLOAT",
@@ -38,11 +50,19 @@ def parse_command_line():
                       help="Set minimum x of the second axis. If not specified, the x limits provided on the first axis will be assumed for the second axis.")
     parser.add_option("--x2-max", type="float", metavar="FLOAT",
                       help="Set maximum x of the second axis. If not specified, the x limits provided on the first axis will be assumed for the second axis.")
+    for i in range(3, max_ndim + 1):
+        for end in ("min", "max"):
+            parser.add_option("--x%d-%s" % (i, end), type="float", metavar="FLOAT",
+                              help="Set %simum x of axis %d, for the coord frames of %d dimensions or more. If not specified, the x limits provided on the first axis will be assumed." % (end, i, i))
     # initial condition options
     parser.add_option("--seed", type="int", metavar="INT", default=42,
                       help="Set the seed for the random number generator used for parameter(x1, x2) generation.")
+    parser.add_option("--random-generator", choices=["mtrand", "pcg64"], default="mtrand",
+                      help="Choose the random number generator: the legacy global numpy state (mtrand), which reproduces the proposals of earlier versions for a given --seed, or a numpy.random.Generator using PCG64. Default mtrand.")
+    parser.add_option("--proposal-strategy", choices=list(samplers.keys()), default="uniform",
+                      help="Choose how the proposals are drawn: uniformly at random (default), from the quasi-random Halton or Sobol' (requires scipy) sequences, or \"adaptive\", which draws the regions not yet covered by accepted templates (tracked by a fine grid) more often, down to the gaps between their ellipses. The adaptive strategy is not available for Polar coordinates and with --resume.")
     parser.add_option("--bank-seed", metavar="FILE", action="append", default=[],
-                      help="Add templates from FILE to the initial bank. Can be specified multiple times. Only the additional templates will be outputted.")
+                      help="Add templates from FILE (a .npy array of shape (d, n) for d parameters, or a bank file written with an output name ending in .bank) to the initial bank. Can be specified multiple times. Only the additional templates will be outputted.")
     # distance calculation options
     parser.add_option("--distance-max", type="float", default=0.1,
                       help="Set maximum distance of the bank. Note that since this is a stochastic process, the requested maximal distance may not be strictly guaranteed but should be fulfilled on a statistical basis. Default: 0.1.")
@@ -52,129 +72,604 @@ def parse_command_line():
                       help="Use this option to force the code to exit after accepting a specified number N of new templates. Note that the code may exit with fewer than N templates if the convergence criterion is met first.")
     parser.add_option("--neighborhood-size", type="float", metavar="N", default=0.25,
                       help="Specify the window size to define \"nearby\" templates used to compute the distance against each proposed template. The neighborhood is chosen symmetric about the proposed template; \"nearby\" is defined using the option --neighborhood-param. The default value of 0.25 is *not a guarantee of performance*. Choosing the neighborhood too small will lead to larger banks (but also higher bank coverage).")
-    parser.add_option("--neighborhood-param", choices=["x1", "x2", "norm"], default="x1",
-                      help="Choose how the neighborhood is sorted for match calculations.")
+    parser.add_option("--neighborhood-param", choices=list(nhood_indices.keys()), default="x1",
+                      help="Choose how the neighborhood is sorted for match calculations. With \"grid\", the templates are put in a uniform cell list whose cell size is set by --distance-max and the metric, and only the cells overlapping the ellipse of a proposal are searched. With \"kdtree\", the parameters are whitened by the Cholesky factor of the metric and the nearest templates are searched in a k-d tree (requires scipy). --neighborhood-size is ignored for both.")
+    parser.add_option("--proposal-batch-size", type="int", metavar="N", default=1,
+                      help="Draw N proposals at a time and reject those already covered by the bank in bulk before checking the rest one by one. The resulting bank is the same as with the default of 1 (one proposal at a time) for the same seed. Cannot be used with --generate-full-plots or --event-log.")
+    parser.add_option("--workers", type="int", metavar="N", default=1,
+                      help="Split the x1 range into N strips (overlapping by twice the largest ellipse extent) which are generated by N processes, seeded with --seed plus the strip number, and merge them at the end: each strip keeps the templates of its own part, those of the overlaps are re-checked, and the bands about the strip boundaries are filled by N - 1 more runs in parallel. --max-new-templates is shared equally among the strips, and what is left of it among the bands. Cannot be used with --generate-full-plots or --event-log.")
+    # checkpoint options
+    parser.add_option("--checkpoint-file", metavar="FILE", default=None,
+                      help="Periodically save the state of the run (bank, counters and random state) to FILE.")
+    parser.add_option("--checkpoint-every", type="int", metavar="N", default=100000,
+                      help="Save a checkpoint every N proposals (rounded up to whole batches of --proposal-batch-size). Default 100000.")
+    parser.add_option("--resume", action="store_true", default=False,
+                      help="Continue the run saved in --checkpoint-file, which then gives the same bank as an uninterrupted run. --bank-seed files are not read again.")
+    # instrumentation options
+    parser.add_option("--stats-file", metavar="FILE", default=None,
+                      help="Write the counters and timers of the run (proposals, distance evaluations, neighborhood sizes, depth of the early exit in the distance calculations, time spent in each phase, acceptance rate...) as JSON lines to FILE, every --stats-every proposals and at the end.")
+    parser.add_option("--stats-every", type="int", metavar="N", default=10000,
+                      help="Write a line to --stats-file every N proposals (rounded up to whole batches of --proposal-batch-size). Default 10000.")
+    parser.add_option("--profile-phase", choices=list(phases), default=None, metavar='|'.join(phases),
+                      help="Profile this phase of the generation loop with cProfile, the statistics are saved to --profile-file.")
+    parser.add_option("--profile-file", metavar="FILE", default=None,
+                      help="File for the statistics of --profile-phase, to be read with pstats. Default: the output name with the extension .prof.")
     # output options
     parser.add_option("--output-filename", default=None,
-                      help="Required. Name for output template bank. May not clash with seed bank.")
+                      help="Required. Name for output template bank. May not clash with seed bank. With the extension .bank, the bank is written in the binary format of bankfile.py (with the options of the run in its header) while it is generated, see --output-chunk; otherwise as a .npy array of shape (d, n) for d parameters.")
+    parser.add_option("--output-chunk", type="int", metavar="N", default=1000,
+                      help="Append the new templates to a .bank output file every N accepted templates, so that an interrupted run leaves a valid bank behind. Default 1000.")
     parser.add_option("--generate-full-plots", action="store_true", default=False,
-                      help="Generate plots during calculation. DO NOT use it for bank size >~ 40, be sure that you know how much storage space it will take!")
+                      help="Generate a frame for each step of the calculation in the directory fig_<output name>, rendered in parallel from the event log (see --event-log) after the run. There are several frames per proposal, be sure that you know how much storage space it will take! See render.py to render only part of them.")
+    parser.add_option("--event-log", metavar="FILE", default=None,
+                      help="Write what happens to each proposal (neighborhood window, compared templates, acceptance) to FILE, from which render.py draws the frames of --generate-full-plots. With --generate-full-plots it defaults to events.log in the frame directory.")
     parser.add_option("--verbose", action="store_true", default=False,
                       help="Be verbose and write diagnostic information out to file.")
 
+    return parser
+
+
+def check_options(opts):
+    """
+    Fill in the options whose default depends on the others, and check the options of a run,
+     raise ValueError if they cannot be used together.
+    """
+    polar = opts.coord_frame in ('Polar', 'PolarMetric')
+    if opts.x2_min is None:
+        if polar:
+            opts.x2_min = 0.
+        else:
+            opts.x2_min = opts.x1_min
+    if opts.x2_max is None:
+        if polar:
+            opts.x2_max = 2 * np.pi
+        else:
+            opts.x2_max = opts.x1_max
+    ndim = coord_frames[opts.coord_frame].ndim
+    for i in range(3, ndim + 1):
+        for end in ("min", "max"):
+            if getattr(opts, "x%d_%s" % (i, end)) is None:
+                setattr(opts, "x%d_%s" % (i, end), getattr(opts, "x1_" + end))
+
+    if polar:
+        if (not 0 <= opts.x1_min <= opts.x1_max) or (not 0 <= opts.x2_min <= opts.x2_max <= 2 * np.pi):
+            raise ValueError("For polar coordinates, (x1, x2) denotes for (r, theta), where r>=0, theta in [0, 2*pi].")
+
+    if coord_frames[opts.coord_frame].varying_metric and opts.neighborhood_param in ('grid', 'kdtree'):
+        raise ValueError("--neighborhood-param %s needs a constant metric, it cannot be used with --coord-frame %s." %
+                         (opts.neighborhood_param, opts.coord_frame))
+
+    if opts.proposal_batch_size < 1:
+        raise ValueError("--proposal-batch-size must be a positive integer.")
+    plots = opts.generate_full_plots or opts.event_log
+    if opts.proposal_batch_size > 1 and plots:
+        raise ValueError("--proposal-batch-size cannot be used with --generate-full-plots or --event-log.")
+    if opts.generate_full_plots and not opts.output_filename:
+        raise ValueError("--generate-full-plots requires --output-filename, which names the directory of the frames.")
+
+    if opts.workers < 1:
+        raise ValueError("--workers must be a positive integer.")
+    if opts.output_chunk < 1:
+        raise ValueError("--output-chunk must be a positive integer.")
+    if opts.workers > 1 and plots:
+        raise ValueError("--workers cannot be used with --generate-full-plots or --event-log.")
+
+    if opts.proposal_strategy == 'adaptive' and (opts.coord_frame == 'Polar' or opts.resume):
+        raise ValueError("--proposal-strategy adaptive cannot be used with Polar coordinates or --resume.")
+    if ndim > 2 and (plots or opts.proposal_strategy == 'adaptive'):
+        raise ValueError("--generate-full-plots, --event-log and --proposal-strategy adaptive need a coord frame "
+                         "of two dimensions.")
+    if opts.stats_file and opts.workers > 1:
+        raise ValueError("--stats-file cannot be used with --workers.")
+    if opts.profile_phase and opts.workers > 1:
+        raise ValueError("--profile-phase cannot be used with --workers.")
+    if opts.profile_phase and not (opts.profile_file or opts.output_filename):
+        raise ValueError("--profile-phase requires --profile-file.")
+    if opts.resume and not opts.checkpoint_file:
+        raise ValueError("--resume requires --checkpoint-file.")
+    if opts.checkpoint_file and (opts.workers > 1 or plots):
+        raise ValueError("--checkpoint-file cannot be used with --workers, --generate-full-plots or --event-log.")
+
+    for seed in opts.bank_seed:
+        if seed == opts.output_filename:
+            raise ValueError("Bank seed %s would be overwritten by output file. Choose a different output name." % seed)
+
+
+def parse_command_line():
+    parser = _option_parser()
     opts_, args_ = parser.parse_args()
 
     # check for required arguments
     for opt in ("coord_frame", "x1_min", "x1_max", "output_filename"):
         if getattr(opts_, opt) is None:
             parser.error("--%s is required" % opt.replace("_", "-"))
+    try:
+        check_options(opts_)
+    except ValueError as e:
+        parser.error(str(e))
 
-    if opts_.x2_min is None:
-        if opts_.coord_frame == 'Polar':
-            opts_.x2_min = 0.
-        else:
-            opts_.x2_min = opts_.x1_min
-    if opts_.x2_max is None:
-        if opts_.coord_frame == 'Polar':
-            opts_.x2_max = 2 * np.pi
+    return opts_, args_
+
+
+def make_config(config=None, **kwargs):
+    """
+    Return the options of a run (an optparse.Values) made of the defaults of the command line, updated by
+     config (a dict, or an object holding the options, e.g. one returned by this function) and then by kwargs.
+    The names of the options are those of the command line with underscores, e.g.
+    >>>make_config(coord_frame='Cartesian', x1_min=0., x1_max=1., distance_max=0.1)
+    Raise ValueError if an option is unknown, missing or invalid.
+    """
+    parser = _option_parser()
+    opts = parser.get_default_values()
+    if config is not None:
+        config = config if isinstance(config, dict) else vars(config)
+        kwargs = dict(config, **kwargs)
+    for key, value in kwargs.items():
+        if not hasattr(opts, key):
+            raise ValueError("Unknown option %r." % key)
+        setattr(opts, key, value)
+
+    for opt in ("coord_frame", "x1_min", "x1_max"):
+        if getattr(opts, opt) is None:
+            raise ValueError("Option %s is required." % opt)
+    for option in parser.option_list:
+        value = getattr(opts, option.dest, None) if option.dest else None
+        if option.choices is not None and value is not None and value not in option.choices:
+            raise ValueError("Invalid %s %r, choose from %s." % (option.dest, value, ', '.join(option.choices)))
+    # a single file name is as good as a list of them, and must not be split into characters
+    bank_seed = opts.bank_seed
+    opts.bank_seed = [bank_seed] if isinstance(bank_seed, (str, os.PathLike)) else list(bank_seed)
+    check_options(opts)
+    return opts
+
+
+# options which must not change when resuming from a checkpoint
+checkpoint_options = ("coord_frame", "x1_min", "x1_max", "x2_min", "x2_max", "seed", "random_generator", "proposal_strategy",
+                      "distance_max", "neighborhood_param", "neighborhood_size") + \
+    tuple("x%d_%s" % (i, end) for i in range(3, max_ndim + 1) for end in ("min", "max"))
+
+
+def save_checkpoint(filename, opts, bank, ks, k, n_prop):
+    """
+    Save the state of a run (bank and counters) to filename, replacing it atomically.
+    There is no need to save the random state, a resumed run draws and skips the first n_prop proposals.
+    """
+    state = {'bank_' + key: value for key, value in bank.get_state().items()}
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        np.savez(f, ks=np.array(ks), k=k, n_prop=n_prop,
+                 options=json.dumps({key: getattr(opts, key) for key in checkpoint_options}), **state)
+    os.replace(tmp_filename, filename)
+
+
+def load_checkpoint(filename, opts, bank):
+    """Restore bank from the checkpoint in filename and return the state of the run as a dict."""
+    with np.load(filename) as f:
+        state = dict(f)
+    options = json.loads(str(state.pop('options')))
+    for key in checkpoint_options:
+        # an option missing from the checkpoint is taken as unset (None)
+        if options.get(key) != getattr(opts, key):
+            raise ValueError("Checkpoint %s was written with %s=%r, cannot resume with %r." %
+                             (filename, key, options.get(key), getattr(opts, key)))
+    bank.set_state({key[len('bank_'):]: value for key, value in state.items() if key.startswith('bank_')})
+    return state
+
+
+def generate_iter(bank, tmplt_class, opts, constraints, resume=None, seed=None, stats=None):
+    """
+    Run the stochastic placement of proposals drawn within constraints until the convergence
+     criterion (or --max-new-templates) is met, accepted proposals are inserted into bank and yielded.
+    The random generator is seeded with seed (opts.seed by default).
+    The run continues from the state returned by load_checkpoint() if resume is given.
+    The phases of the loop are timed and counted in stats, a RunStats which may write them to a file.
+    Return (as the value of StopIteration) the total number of proposals.
+    """
+    # For robust convergence, ensure that an average of k_max/len(ks) of
+    # the last len(ks) proposals have been rejected by SBank.
+    ks = deque(10 * [1], maxlen=10)
+    k = 0  # k is n_prop per iteration
+    n_prop = 0  # count total number of proposed templates
+    if resume is not None:
+        ks.extend(int(i) for i in resume['ks'])
+        k, n_prop = int(resume['k']), int(resume['n_prop'])
+    last_checkpoint = n_prop
+    if stats is None:
+        stats = RunStats(n_prop=n_prop)
+    counts = stats.counts
+
+    seed = opts.seed if seed is None else seed
+    if opts.random_generator == 'mtrand':
+        np.random.mtrand.seed(seed)
+        rng = None
+    else:
+        rng = np.random.default_rng(seed)
+    # proposals are drawn in large chunks which are cut into batches, the n_prop proposals
+    # of a resumed run are drawn again and skipped to replay the same random sequence
+    batch_size = opts.proposal_batch_size
+    if opts.proposal_strategy == 'adaptive':
+        # smaller chunks, which are drawn from a more recent state of the occupancy grid; their size does not
+        # depend on the batch size (the last batch of a chunk is shorter), so that each chunk is drawn after
+        # the same proposals whatever the batch size, which gives the same bank
+        occupancy = OccupancyGrid(tmplt_class, opts.distance_max, **constraints)
+        occupancy.add(bank.to_array())
+        sampler_kwargs = {'occupancy': occupancy}
+        chunk_size = 1024
+    else:
+        occupancy = None
+        sampler_kwargs = {}
+        chunk_size = batch_size * max(1, 65536 // batch_size)
+    chunks = proposal_chunks[opts.coord_frame](chunk_size, rng, n_prop, sampler=samplers[opts.proposal_strategy],
+                                               **sampler_kwargs, **constraints)
+    batches = (chunk[i:i+batch_size] for chunk in chunks for i in range(0, chunk_size, batch_size))
+
+    # main working loop
+    finished = False
+    while not finished:
+        start = stats.enter('draw')
+        batch = next(batches)
+        stats.exit('draw', start)
+        if batch_size > 1:
+            # reject in bulk the proposals covered by the bank as it stands before this batch;
+            # since the bank only grows, a serial run would have rejected each of them as well
+            start = stats.enter('covers_many')
+            covered = bank.covers_many(batch, opts.distance_max)
+            stats.exit('covers_many', start)
         else:
-            opts_.x2_max = opts_.x1_max
+            covered = [False]
 
-    if opts_.coord_frame == 'Polar':
-        if (not 0 <= opts_.x1_min <= opts_.x1_max) or (not 0 <= opts_.x2_min <= opts_.x2_max <= 2 * np.pi):
-            parser.error("For polar coordinates, (x1, x2) denotes for (r, theta), where r>=0, theta in [0, 2*pi].")
+        for params, is_covered in zip(batch.tolist(), covered):
 
-    for seed in opts_.bank_seed:
-        if seed == opts_.output_filename:
-            raise ValueError("Bank seed %s would be overwritten by output file. Choose a different output name." % seed)
+            # check if stopping criterion has been reached
+            if not (((k + float(sum(ks))) / len(ks) < opts.convergence_threshold) and
+                    (len(bank) < opts.max_new_templates)):
+                finished = True
+                break
+            # accounting for number of proposals
+            k += 1  # since last acceptance
+            n_prop += 1  # total throughout lifetime of process
+            if is_covered:
+                counts['bulk_rejected'] += 1
+                continue
+            start = stats.enter('covers')
+            tmplt = tmplt_class(*params)
+
+            # check if proposal is already covered by existing templates
+            distance, matcher = bank.covers(tmplt, opts.distance_max, n_prop)
+            stats.exit('covers', start)
+            if distance > opts.distance_max:
+                start = stats.enter('insort')
+                bank.insort(tmplt, n_prop)
+                if occupancy is not None:
+                    occupancy.add(params)
+                stats.exit('insort', start)
+                counts['accepted'] += 1
+                ks.append(k)
+                if opts.verbose:
+                    print("\nbank size: %d\t\tproposed: %d\trejection rate: %.6f / (%.6f)" %
+                          (len(bank), n_prop, 1-float(len(ks))/float(sum(ks)), 1-1./opts.convergence_threshold))
+                    print("accepted:\t\t", tmplt)
+                    if matcher is not None:
+                        print("min distance (%.4f):\t" % distance, matcher)
+                k = 0
+                yield tmplt
+
+        # only save between batches, when no drawn proposal is left unprocessed
+        if opts.checkpoint_file and not finished and n_prop - last_checkpoint >= opts.checkpoint_every:
+            start = stats.enter('checkpoint')
+            save_checkpoint(opts.checkpoint_file, opts, bank, ks, k, n_prop)
+            stats.exit('checkpoint', start)
+            last_checkpoint = n_prop
+        if stats.due(n_prop):
+            stats.write(bank, n_prop, (k + float(sum(ks))) / len(ks))
+    stats.write(bank, n_prop, (k + float(sum(ks))) / len(ks), final=True)
+    return n_prop
+
+
+def _exhaust(gen):
+    """Run the generator gen to its end and return its return value."""
+    while 1:
+        try:
+            next(gen)
+        except StopIteration as stop:
+            return stop.value
 
-    return opts_, args_
 
+def generate(bank, tmplt_class, opts, constraints, resume=None, seed=None, stats=None):
+    """Run generate_iter() to its end and return the total number of proposals."""
+    return _exhaust(generate_iter(bank, tmplt_class, opts, constraints, resume, seed, stats))
 
-print(strftime('%Y/%m/%d %H:%M:%S'))
-opts, args = parse_command_line()
-if opts.generate_full_plots:
-    fig_dir = f'fig_{opts.output_filename[:-4]}'
-    os.makedirs(fig_dir, exist_ok=False)
-else:
-    fig_dir = ''
 
-# choose coord_frame
-tmplt_class = coord_frames[opts.coord_frame]
+def _generate_strip(args):
+    """
+    Generate the bank of one strip in a worker process, return the new templates, the number of proposals
+     and the number of distance evaluations.
+    """
+    opts, tmplt_class, constraints, seed, seed_arr = args
+    bank = Bank(opts.neighborhood_size, opts.neighborhood_param, tmplt_class=tmplt_class)
+    bank.add_from_array(seed_arr, tmplt_class)
+    n_prop = generate(bank, tmplt_class, opts, constraints, seed=seed)
+    return bank.to_array(seeds=False), n_prop, bank._nmatch
 
-# initialize the bank
-bank = Bank(opts.neighborhood_size, opts.neighborhood_param, if_plot=opts.generate_full_plots)
 
-# add templates to bank
-for seed_file in opts.bank_seed:
-    arr = np.load(seed_file).T
-    bank.add_from_array(arr, tmplt_class)
+def _strip_coord(coord_frame, params):
+    """Return the coordinate of the templates at params along which the strips are cut, i.e. r for Polar."""
+    return np.hypot(*params[:, :2].T) if coord_frame == 'Polar' else params[:, 0]
+
+
+def _insert_uncovered(bank, tmplt_class, params, distance_max, max_size=np.inf):
+    """
+    Insert the templates of params, one by one, which are not covered by bank yet, until the bank holds
+     max_size templates; return their number.
+    """
+    n = len(bank)
+    for row in params.tolist():
+        if len(bank) >= max_size:
+            break
+        tmplt = tmplt_class(*row)
+        distance, _ = bank.covers(tmplt, distance_max)
+        if distance > distance_max:
+            bank.insort(tmplt)
+    return len(bank) - n
+
+
+def generate_sharded(bank, tmplt_class, opts, constraints):
+    """
+    Split the x1 range of constraints into opts.workers strips which are generated in parallel,
+     each one extended by an overlap margin on both sides and seeded with opts.seed + (strip number).
+    Each strip owns its core [lo, hi): the templates it placed there are kept as they are. Those it placed
+     in the overlap with its neighbors are then re-checked one by one against the merged bank and only
+     inserted if not covered. At last, what is left uncovered in the band of twice the margin about each inner
+     boundary is filled by runs in parallel (seeded with opts.seed + opts.workers + (boundary number)) against
+     the merged bank, whose templates are re-checked in the same way. Nearly all the proposals of a band
+     are covered already, so the band runs draw them in large batches, which are rejected at little cost.
+    --max-new-templates is shared equally among the strips, and what is left of it among the bands.
+    Return the total number of proposals.
+    """
+    x1_min, x1_max = constraints['x1']
+    edges = np.linspace(x1_min, x1_max, opts.workers + 1)
+    # twice the largest extent of an ellipse, so that the templates covering the boundary
+    # region of a strip are generated by its neighbor as well
+    margin = 2 * opts.distance_max * np.sqrt(max(tmplt_class.vals))
+    seed_arr = bank.to_array()
+    strip_opts = copy(opts)
+    # every strip starts from the seeds, which count in the size of its bank
+    strip_opts.max_new_templates = len(seed_arr) + (opts.max_new_templates - len(seed_arr)) / opts.workers
+    tasks = [(strip_opts, tmplt_class,
+              dict(constraints, x1=(max(lo - margin, x1_min), min(hi + margin, x1_max))),
+              opts.seed + i, seed_arr)
+             for i, (lo, hi) in enumerate(zip(edges[:-1], edges[1:]))]
+    with Pool(opts.workers) as pool:
+        results = pool.map(_generate_strip, tasks)
+
+        core, overlap = [], []
+        for i, (params, _, _) in enumerate(results):
+            x = _strip_coord(opts.coord_frame, params)
+            # the last strip owns its upper limit as well
+            own = (edges[i] <= x) & ((x < edges[i+1]) | (i == opts.workers - 1))
+            core.append(params[own])
+            overlap.append(params[~own])
+        bank.add_from_array(np.concatenate(core), tmplt_class, is_seed_point=False)
+        n_core = len(bank)
+        overlap = np.concatenate(overlap)
+        n_overlap = _insert_uncovered(bank, tmplt_class, overlap, opts.distance_max, opts.max_new_templates)
+
+        # the cores were generated against templates of their neighbors which may be left out, so the
+        # regions near the boundaries are filled as a serial run would do
+        merged = bank.to_array()
+        x = _strip_coord(opts.coord_frame, merged)
+        budget = (opts.max_new_templates - len(bank)) / max(opts.workers - 1, 1)
+        tasks = []
+        for j, edge in enumerate(edges[1:-1]):
+            lo, hi = max(edge - margin, x1_min), min(edge + margin, x1_max)
+            near = merged[(lo - margin <= x) & (x <= hi + margin)]
+            band_opts = copy(opts)
+            band_opts.proposal_batch_size = max(opts.proposal_batch_size, 1024)
+            band_opts.max_new_templates = len(near) + max(budget, 0)
+            tasks.append((band_opts, tmplt_class, dict(constraints, x1=(lo, hi)), opts.seed + opts.workers + j,
+                          near))
+        fills = pool.map(_generate_strip, tasks)
+    n_fill = _insert_uncovered(bank, tmplt_class, np.concatenate([params for params, _, _ in fills]),
+                               opts.distance_max, opts.max_new_templates)
+    # the distance evaluations of the strips and bands are counted as well as those of the merge
+    bank._nmatch += sum(nmatch for _, _, nmatch in results + fills)
     if opts.verbose:
-        print("Added %d seed templates from %s to initial bank." % (len(arr), seed_file))
-
-if opts.verbose:
-    print("Initialized the template bank to seed with %d precomputed templates." % len(bank))
-
-np.random.mtrand.seed(opts.seed)
-
-constraints = {'x1': (opts.x1_min, opts.x1_max),
-               'x2': (opts.x2_min, opts.x2_max)}
-proposal = proposals[opts.coord_frame](tmplt_class, **constraints)
-
-# For robust convergence, ensure that an average of k_max/len(ks) of
-# the last len(ks) proposals have been rejected by SBank.
-ks = deque(10 * [1], maxlen=10)
-k = 0  # k is n_prop per iteration
-n_prop = 0  # count total number of proposed templates
-
-# main working loop
-for tmplt in proposal:
-
-    # check if stopping criterion has been reached
-    if not (((k + float(sum(ks))) / len(ks) < opts.convergence_threshold) and
-            (len(bank) < opts.max_new_templates)):
-        break
-    # accounting for number of proposals
-    k += 1  # since last acceptance
-    n_prop += 1  # total throughout lifetime of process
-    prefix = f'{fig_dir}/{n_prop:0>5d}'
-
-    # check if proposal is already covered by existing templates
-    distance, matcher = bank.covers(tmplt, opts.distance_max, prefix)
-    if distance > opts.distance_max:
-        bank.insort(tmplt, prefix)
-        ks.append(k)
+        print("Merged %d strips: %d of %d templates in the overlaps were kept and %d were added near the "
+              "strip boundaries." % (opts.workers, n_overlap, len(overlap), n_fill))
+    return sum(n_prop for _, n_prop, _ in results + fills)
+
+
+def run_constraints(opts):
+    """Return the constraints of a run, {'x1': (x1_min, x1_max), 'x2': ...} for each axis of its coord frame."""
+    return {'x%d' % i: (getattr(opts, 'x%d_min' % i), getattr(opts, 'x%d_max' % i))
+            for i in range(1, coord_frames[opts.coord_frame].ndim + 1)}
+
+
+def _writes_bank_file(opts):
+    return bool(opts.output_filename) and opts.output_filename.endswith(bankfile.extension)
+
+
+def _write_through(gen, bank, writer, every):
+    """Yield from gen, appending the new templates of bank to writer every `every` templates, return its value."""
+    while 1:
+        try:
+            tmplt = next(gen)
+        except StopIteration as stop:
+            return stop.value
+        if len(bank) - writer.rows >= every:
+            writer.append(bank.rows(writer.rows))
+        yield tmplt
+
+
+def _run_iter(opts, seeds=None):
+    """
+    Set up the bank of a run with opts (see make_config()) and seeds (an optional (n, d) array of templates),
+     generate it and yield the accepted templates. Return (as the value of StopIteration) (bank, n_prop).
+    """
+    opts = copy(opts)
+    if opts.generate_full_plots:
+        fig_dir = f'fig_{os.path.splitext(opts.output_filename)[0]}'
+        os.makedirs(fig_dir, exist_ok=False)
+        if opts.event_log is None:
+            opts.event_log = os.path.join(fig_dir, 'events.log')
+
+    # choose coord_frame
+    tmplt_class = coord_frames[opts.coord_frame]
+
+    # initialize the bank
+    if opts.neighborhood_param == 'grid':
+        # cells as large as the semi-major axis of the ellipses, so that a proposal only meets a few of them
+        opts.neighborhood_size = opts.distance_max * np.sqrt(max(tmplt_class.vals))
+    events = None
+    if opts.event_log:
+        events = EventLog(opts.event_log, {'coord_frame': opts.coord_frame, 'distance_max': opts.distance_max,
+                                           'nhood_param': opts.neighborhood_param,
+                                           'nhood_size': opts.neighborhood_size})
+    bank = Bank(opts.neighborhood_size, opts.neighborhood_param, events=events, tmplt_class=tmplt_class)
+
+    if opts.resume:
+        # the checkpoint holds the seed templates as well
+        resume = load_checkpoint(opts.checkpoint_file, opts, bank)
+        if opts.verbose:
+            print("Resumed from %s with %d templates after %d proposals." %
+                  (opts.checkpoint_file, len(bank), resume['n_prop']))
+    else:
+        resume = None
+        # add templates to bank
+        if seeds is not None:
+            bank.add_from_array(np.reshape(seeds, (-1, tmplt_class.ndim)), tmplt_class)
+        for seed_file in opts.bank_seed:
+            if bankfile.is_bank_file(seed_file):
+                header, arr, order = bankfile.read_bank(seed_file)
+                if header.get('coord_frame', opts.coord_frame) != opts.coord_frame:
+                    raise ValueError("Bank seed %s was generated with --coord-frame %s." %
+                                     (seed_file, header['coord_frame']))
+                order = bankfile.stored_order(header, order, opts.neighborhood_param, opts.neighborhood_size)
+            else:
+                arr, order = np.load(seed_file, mmap_mode='r').T, None
+            if arr.shape[1:] != (tmplt_class.ndim,):
+                raise ValueError("Bank seed %s holds templates of %d parameters, --coord-frame %s has %d." %
+                                 (seed_file, arr.shape[1] if arr.ndim == 2 else 1, opts.coord_frame, tmplt_class.ndim))
+            bank.add_from_array(arr, tmplt_class, order=order)
+            if opts.verbose:
+                print("Added %d seed templates from %s to initial bank." % (len(arr), seed_file))
+
         if opts.verbose:
-            print("\nbank size: %d\t\tproposed: %d\trejection rate: %.6f / (%.6f)" %
-                  (len(bank), n_prop, 1-float(len(ks))/float(sum(ks)), 1-1./opts.convergence_threshold))
-            print("accepted:\t\t", tmplt)
-            if matcher is not None:
-                print("min distance (%.4f):\t" % distance, matcher)
-        k = 0
-
-scatter_points = np.array([i.params for i in iter(bank)]).T
-np.save(opts.output_filename, scatter_points)
-print("\ntotal number of proposed templates: %d" % n_prop)
-# print("total number of match calculations: %d" % bank._nmatch)
-print("final bank size: %d" % len(bank))
-print(strftime('%Y/%m/%d %H:%M:%S'))
-
-
-fig, ax = plt.subplots(figsize=(6, 6))
-w, h = 2*opts.distance_max*np.sqrt(tmplt_class.vals)
-ec = EllipseCollection(w, h, tmplt_class.ang, units='xy', color='darkblue', alpha=0.2,
-                       offsets=np.column_stack(scatter_points), offset_transform=ax.transData)
-ax.add_collection(ec)
-ax.scatter(*scatter_points, s=1, c='darkblue', marker='.')
-# from matplotlib.patches import Arc
-# ax.add_patch(Arc((0, 0), 2, 2, 0, 0, 90, color='navy', fill=False))
-ax.set_xlabel('$x_1$', fontsize=24)
-ax.set_ylabel('$x_2$', fontsize=24)
-ax.set_xlim(0, 1)
-ax.set_ylim(0, 1)  # TODO: improve these hard-coded settings
-ax.tick_params(labelsize=16)
-ax.grid(which='both', zorder=1, alpha=0.5)
-ax.set_aspect('equal')
-plt.tight_layout()
-plt.show()
-plt.savefig(f'{opts.output_filename[:-4]}.png')
+            print("Initialized the template bank to seed with %d precomputed templates." % len(bank))
+
+    writer = None
+    if _writes_bank_file(opts):
+        # the seeds are written as well, as they are part of the output
+        if opts.resume and os.path.exists(opts.output_filename):
+            writer = bankfile.BankWriter(opts.output_filename, rows=len(bank))
+        else:
+            writer = bankfile.BankWriter(opts.output_filename, bankfile.bank_header(
+                tmplt_class, **{key: getattr(opts, key) for key in checkpoint_options}))
+        writer.append(bank.rows(writer.rows))
+
+    constraints = run_constraints(opts)
+    try:
+        if opts.workers > 1:
+            n_prop = generate_sharded(bank, tmplt_class, opts, constraints)
+            for params in bank.to_array(seeds=False).tolist():
+                yield tmplt_class(*params)
+        else:
+            stats = RunStats(opts.stats_file, opts.stats_every, 0 if resume is None else int(resume['n_prop']))
+            if opts.profile_phase:
+                profiler = cProfile.Profile()
+                stats.add_hook(opts.profile_phase, profiler)
+            try:
+                gen = generate_iter(bank, tmplt_class, opts, constraints, resume, stats=stats)
+                if writer is not None:
+                    gen = _write_through(gen, bank, writer, opts.output_chunk)
+                n_prop = yield from gen
+            finally:
+                stats.close()
+            if opts.profile_phase:
+                profiler.dump_stats(opts.profile_file or f'{os.path.splitext(opts.output_filename)[0]}.prof')
+        if writer is not None:
+            writer.append(bank.rows(writer.rows))
+            writer.header['proposals'] = n_prop
+            writer.write_order(bank.order(), opts.neighborhood_param, opts.neighborhood_size)
+    finally:
+        if events is not None:
+            events.close()
+        if writer is not None:
+            writer.close()
+
+    if opts.generate_full_plots:
+        n_frames = render_frames(opts.event_log, fig_dir)
+        if opts.verbose:
+            print("Rendered %d frames to %s." % (n_frames, fig_dir))
+    return bank, n_prop
+
+
+def generate_bank(config=None, seeds=None, **kwargs):
+    """
+    Generate a bank with the options given by config and kwargs (see make_config()) and return it (a Bank).
+    seeds is an optional (n, d) array of templates to start from, as well as the --bank-seed files.
+    Nothing is written to disk except for the files asked for by the options (checkpoints, logs, plots...),
+     and output_filename if it is a bank file (with the extension .bank).
+    """
+    bank, _ = _exhaust(_run_iter(make_config(config, **kwargs), seeds))
+    return bank
+
+
+def iter_templates(config=None, seeds=None, **kwargs):
+    """
+    Like generate_bank(), but yield the new templates (Template() objects) as they are accepted.
+    With --workers, they are yielded once all the strips are generated and merged.
+    """
+    yield from _run_iter(make_config(config, **kwargs), seeds)
+
+
+def plot_bank(bank, distance_max, filename=None, show=False):
+    """
+    Plot the templates of bank with their ellipses of radius distance_max, save the figure to filename.
+    Banks of more than two dimensions are projected onto (x1, x2), without the ellipses.
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import EllipseCollection
+
+    scatter_points = bank.to_array()[:, :2].T
+    fig, ax = plt.subplots(figsize=(6, 6))
+    if bank.tmplt_class.ndim == 2:
+        w, h, ang = bank.tmplt_class.ellipses(scatter_points.T, distance_max)
+        ec = EllipseCollection(w, h, ang, units='xy', color='darkblue', alpha=0.2,
+                               offsets=np.column_stack(scatter_points), offset_transform=ax.transData)
+        ax.add_collection(ec)
+    ax.scatter(*scatter_points, s=1, c='darkblue', marker='.')
+    # from matplotlib.patches import Arc
+    # ax.add_patch(Arc((0, 0), 2, 2, 0, 0, 90, color='navy', fill=False))
+    ax.set_xlabel('$x_1$', fontsize=24)
+    ax.set_ylabel('$x_2$', fontsize=24)
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1)  # TODO: improve these hard-coded settings
+    ax.tick_params(labelsize=16)
+    ax.grid(which='both', zorder=1, alpha=0.5)
+    ax.set_aspect('equal')
+    plt.tight_layout()
+    if filename:
+        plt.savefig(filename)
+    if show:
+        plt.show()
+    return fig
+
+
+def main():
+    print(strftime('%Y/%m/%d %H:%M:%S'))
+    opts, args = parse_command_line()
+    bank, n_prop = _exhaust(_run_iter(opts))
+
+    if not _writes_bank_file(opts):
+        np.save(opts.output_filename, bank.to_array().T)
+    print("\ntotal number of proposed templates: %d" % n_prop)
+    print("total number of match calculations: %d" % bank._nmatch)
+    print("final bank size: %d" % len(bank))
+    print(strftime('%Y/%m/%d %H:%M:%S'))
+
+    plot_bank(bank, opts.distance_max, f'{os.path.splitext(opts.output_filename)[0]}.png', show=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -41,3 +41,27 @@ python3 sbank.py --coord-frame Polar \
                  --neighborhood-size 0.2 \
                  --output-filename test_polar.npy \
                  --verbose \
+
+# example 4 (54 templates), (r, theta) with the polar metric dr^2 + r^2 dtheta^2
+python3 sbank.py --coord-frame PolarMetric \
+                 --x1-min 0. \
+                 --x1-max 1. \
+                 --x2-min 0. \
+                 --x2-max 1.5707963267948966 \
+                 --distance-max 0.1 \
+                 --neighborhood-size 0.2 \
+                 --output-filename test_polar_metric.npy \
+                 --verbose \
+
+# check that pruning a merged bank never leaves more injections uncovered (measured with verify.py)
+python3 checks.py prune --workers 4
+
+# check that the .npy output of sbank.py is the same with --proposal-batch-size 1, 64 and 1024
+python3 checks.py batch
+
+# check that a run killed and resumed from its --checkpoint-file gives the bank of an uninterrupted run,
+# and that the grid and kdtree indices give the same templates as the x1 window
+python3 checks.py resume
+
+# check that BankFilter.peak_snrs() finds the peak SNR and time of pycbc's matched_filter() (requires pycbc)
+python3 checks.py filterbank
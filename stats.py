@@ -0,0 +1,79 @@
+"""
+This code provides the instrumentation of the generation loop: counters and timers of its phases,
+ written periodically as JSON lines to a stats file, and an optional profiling hook for some phases.
+"""
+from time import perf_counter
+import json
+
+# phases of the generation loop which are timed
+phases = ('draw', 'covers_many', 'covers', 'insort', 'checkpoint')
+
+
+class RunStats(object):
+    """
+    Counters and timers of a generation run. A phase is timed by start = stats.enter(phase) and
+     stats.exit(phase, start); a hook with enable() and disable() methods (e.g. a cProfile.Profile)
+     can be attached to any phase with add_hook(), it is only enabled during that phase.
+    If filename is given, write() appends a JSON line with the current state of the run to it;
+     n_prop is the number of proposals made before, by the run which is resumed (the file is then appended to).
+    """
+    __slots__ = ('file', 'every', 'times', 'counts', 'hooks', '_start', '_last')
+
+    def __init__(self, filename=None, every=10000, n_prop=0):
+        self.file = open(filename, 'a' if n_prop else 'w') if filename else None
+        self.every = every
+        self.times = dict.fromkeys(phases, 0.)
+        # proposals rejected in bulk by covers_many(), and accepted ones
+        self.counts = {'bulk_rejected': 0, 'accepted': 0}
+        self.hooks = {}
+        self._start = perf_counter()
+        self._last = {'proposals': n_prop, 'accepted': 0, 'time': 0.}
+
+    def add_hook(self, phase, hook):
+        if phase not in self.times:
+            raise ValueError("Unknown phase %r, choose from %s." % (phase, ', '.join(phases)))
+        self.hooks[phase] = hook
+
+    def enter(self, phase):
+        if self.hooks and phase in self.hooks:
+            self.hooks[phase].enable()
+        return perf_counter()
+
+    def exit(self, phase, start):
+        self.times[phase] += perf_counter() - start
+        if self.hooks and phase in self.hooks:
+            self.hooks[phase].disable()
+
+    def due(self, n_prop):
+        """Tell whether a line is due after n_prop proposals."""
+        return self.file is not None and n_prop - self._last['proposals'] >= self.every
+
+    def snapshot(self, bank, n_prop, convergence=None, final=False):
+        """Return the state of the run as a dict, rates are taken over the interval since the last line."""
+        elapsed = perf_counter() - self._start
+        counters = bank.counters()
+        last = self._last
+        n, accepted, dt = (n_prop - last['proposals'], self.counts['accepted'] - last['accepted'],
+                           elapsed - last['time'])
+        record = {'time': elapsed, 'proposals': n_prop, 'templates': len(bank)}
+        record.update(self.counts)
+        record.update(counters)
+        record.update({'mean_window': counters['candidates'] / max(counters['windows'], 1),
+                       'mean_examined': counters['examined'] / max(counters['covers'], 1),
+                       'proposals_per_sec': n / dt if dt > 0 else None,
+                       'acceptance_rate': accepted / n if n else None,
+                       'convergence': convergence, 'final': final})
+        record.update(('time_' + phase, t) for phase, t in self.times.items())
+        self._last = {'proposals': n_prop, 'accepted': self.counts['accepted'], 'time': elapsed}
+        return record
+
+    def write(self, bank, n_prop, convergence=None, final=False):
+        record = self.snapshot(bank, n_prop, convergence, final)
+        if self.file is not None:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+        return record
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
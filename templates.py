@@ -1,86 +1,478 @@
 """
 This code provides Template classes, and generators used to propose trial points in some distributions.
 """
+import warnings
+from math import sqrt
+
 import numpy as np
 from numpy.random.mtrand import uniform
-from matplotlib.patches import Ellipse
 
 
-def uniform_points_generator(**constraints):
-    """Uniformly generate points in 2d."""
-    x1_min, x1_max = constraints.pop('x1')
-    x2_min, x2_max = constraints.pop('x2')
+def _box(constraints):
+    """Return the corners (low, high) of the box given by the constraints x1, ..., xd of the axes as two arrays."""
+    names = ['x%d' % i for i in range(1, len(constraints) + 1)]
+    low, high = np.array([constraints[name] for name in names], dtype=float).T
+    return low, high
+
 
+def uniform_points_chunks(chunk_size=65536, rng=None, skip=0, **constraints):
+    """
+    Uniformly generate points in the box of constraints (x1, ..., xd), chunk_size points at a time as an (n, d) array.
+    rng is a numpy.random.Generator, by default the global (legacy) numpy random state is used,
+     which gives the same points as drawing (x1, x2) one by one, whatever the chunk_size.
+    The first skip points of the sequence are drawn and thrown away.
+    """
+    low, high = _box(constraints)
+    draw = uniform if rng is None else rng.uniform
+
+    while skip > 0:
+        skipped = min(skip, chunk_size)
+        draw(low, high, size=(skipped, len(low)))
+        skip -= skipped
     while 1:   # This is inexplicably much faster than "while True"
-        x1 = uniform(x1_min, x1_max)
-        x2 = uniform(x2_min, x2_max)
-        yield x1, x2
+        yield draw(low, high, size=(chunk_size, len(low)))
+
+
+def _radical_inverse(indices, base):
+    """Return the radical inverse of integer indices (an array) in base, i.e. their digits mirrored about the point."""
+    indices = np.array(indices)
+    result = np.zeros(len(indices))
+    f = 1.
+    while indices.any():
+        f /= base
+        result += f * (indices % base)
+        indices //= base
+    return result
+
+
+# bases of the Halton sequence, one for each axis
+halton_bases = (2, 3, 5, 7, 11, 13)
+
+
+def halton_points_chunks(chunk_size=65536, rng=None, skip=0, **constraints):
+    """
+    Generate points of the Halton sequence (bases 2, 3, 5... for the axes x1, x2, x3...), chunk_size points
+     at a time as an (n, d) array.
+    The sequence is shifted by a random vector modulo 1 (Cranley-Patterson rotation), drawn from rng
+     (by default the global numpy random state), so that each seed gives a different sequence.
+    The first skip points of the sequence are left out.
+    """
+    low, high = _box(constraints)
+    width = high - low
+    shift = uniform(size=len(low)) if rng is None else rng.uniform(size=len(low))
+
+    start = skip + 1  # leave out the origin
+    while 1:
+        indices = np.arange(start, start + chunk_size)
+        points = np.column_stack([_radical_inverse(indices, base) for base in halton_bases[:len(low)]])
+        yield low + width * ((points + shift) % 1)
+        start += chunk_size
+
+
+def sobol_points_chunks(chunk_size=65536, rng=None, skip=0, **constraints):
+    """
+    Generate points of a scrambled Sobol' sequence (requires scipy) in the box of constraints (x1, ..., xd),
+     chunk_size points at a time as an (n, d) array.
+    The scrambling is seeded from rng (by default the global numpy random state).
+    The first skip points of the sequence are left out.
+    """
+    from scipy.stats import qmc
+
+    low, high = _box(constraints)
+    width = high - low
+    sobol = qmc.Sobol(len(low), scramble=True, seed=np.random.mtrand.randint(2**31) if rng is None else rng)
+    if skip:
+        sobol.fast_forward(skip)
+
+    while 1:
+        with warnings.catch_warnings():
+            # the balance properties of the sequence hold for its whole length, not for each chunk
+            warnings.simplefilter('ignore', UserWarning)
+            points = sobol.random(chunk_size)
+        yield low + width * points
+
+
+class OccupancyGrid(object):
+    """
+    Grid over the box of constraints, which tracks the cells lying within max_distance of some template,
+     i.e. whose four corners lie within the ellipse of one template, which are then covered already.
+    The cells are squares with a side of a quarter of the semi-minor axis of the ellipses, so that the cells
+     at the edge of an ellipse, which are only partly covered, are a small part of its area.
+    """
+    __slots__ = ('tmplt_class', 'max_distance', 'low', 'cell', 'covered', '_offsets')
+
+    def __init__(self, tmplt_class, max_distance, **constraints):
+        x1_min, x1_max = constraints.pop('x1')
+        x2_min, x2_max = constraints.pop('x2')
+        self.tmplt_class = tmplt_class
+        self.max_distance = max_distance
+        self.low = np.array((x1_min, x2_min))
+        width = np.array((x1_max - x1_min, x2_max - x2_min))
+        shape = np.maximum(np.ceil(4 * width / (max_distance * np.sqrt(min(tmplt_class.vals)))), 1).astype(int)
+        self.cell = width / shape
+        self.covered = np.zeros(shape, dtype=bool)
+        # offsets of the cells which may lie within an ellipse, about the cell of its centre
+        reach = np.ceil(max_distance * tmplt_class.half_axes / self.cell).astype(int)
+        self._offsets = np.stack(np.meshgrid(np.arange(-reach[0], reach[0]+1), np.arange(-reach[1], reach[1]+1),
+                                             indexing='ij'), axis=-1).reshape(-1, 2)
 
+    def add(self, params):
+        """Mark the cells covered by the templates at params, an (m, 2) array."""
+        params = np.reshape(params, (-1, 2))
+        cells = np.floor((params - self.low) / self.cell).astype(int)
+        cells = (cells[:, None, :] + self._offsets).reshape(-1, 2)
+        centres = np.repeat(params, len(self._offsets), axis=0)
+        coeffs = None
+        if self.tmplt_class.varying_metric:
+            # the cells are only searched within the ellipse of the class metric, which is fine
+            # since missing a covered cell merely makes it drawn more often
+            coeffs = np.repeat(self.tmplt_class.coeffs_at(params), len(self._offsets), axis=0)
+        inside = (cells >= 0).all(axis=1) & (cells < self.covered.shape).all(axis=1)
+        # the ellipse is convex, so it holds the whole cell if it holds its corners
+        for corner in ((0, 0), (0, 1), (1, 0), (1, 1)):
+            dx = self.low + (cells + corner) * self.cell - centres
+            inside &= self.tmplt_class.distances(dx, coeffs) <= self.max_distance
+        self.covered[tuple(cells[inside].T)] = True
 
-def cartesian_uniform_generator(tmplt_class, **constraints):
-    """Uniformly generate templates in 2d, here (x1, x2) denotes for (x, y)."""
-    for x1, x2 in uniform_points_generator(**constraints):
-        yield tmplt_class(x1, x2)
 
+def adaptive_points_chunks(chunk_size=1024, rng=None, skip=0, occupancy=None, covered_weight=0.02, **constraints):
+    """
+    Generate points in 2d, chunk_size points at a time as an (n, 2) array, biased toward the cells of occupancy
+     (an OccupancyGrid, which the caller keeps up to date with the accepted templates) not covered yet:
+     a covered cell is drawn covered_weight times as often as the others, so that the proposals go to the
+     regions without templates and then to the gaps between the ellipses, whose cells are never covered
+     by a single one. The points are given in the coordinates of the grid.
+    Since the points depend on the history of the bank, they cannot be replayed, i.e. skip must be 0.
+    """
+    if skip:
+        raise ValueError("Adaptive sampling depends on the bank and cannot skip points.")
+    draw = uniform if rng is None else rng.uniform
+
+    while 1:
+        weights = np.where(occupancy.covered.ravel(), covered_weight, 1.)
+        cumulative = np.cumsum(weights)
+        cells = np.searchsorted(cumulative, draw(0, cumulative[-1], size=chunk_size), side='right')
+        cells = np.column_stack(np.unravel_index(np.minimum(cells, len(weights) - 1), occupancy.covered.shape))
+        yield occupancy.low + (cells + draw(size=(chunk_size, 2))) * occupancy.cell
+
+
+def uniform_points_generator(chunk_size=65536, rng=None, skip=0, **constraints):
+    """Uniformly generate points in the box of constraints."""
+    for chunk in uniform_points_chunks(chunk_size, rng, skip, **constraints):
+        yield from chunk.tolist()
+
+
+def cartesian_uniform_chunks(chunk_size=65536, rng=None, skip=0, sampler=uniform_points_chunks, **constraints):
+    """
+    Generate template parameters in chunks of (n, d) arrays, here (x1, x2, ...) denotes for the Cartesian (x, y, ...).
+    The points are drawn by sampler (uniformly by default), any extra keyword is passed to it.
+    """
+    return sampler(chunk_size, rng, skip, **constraints)
+
+
+def polar_uniform_chunks(chunk_size=65536, rng=None, skip=0, sampler=uniform_points_chunks, **constraints):
+    """
+    Generate template parameters in 2d in chunks of (n, 2) arrays, here (x1, x2) denotes for (r, theta),
+     where r>=0, theta in [0, 2*pi]. The chunks hold the corresponding Cartesian coordinates.
+    The points (r, theta) are drawn by sampler (uniformly by default), any extra keyword is passed to it.
+    """
+    for r, theta in (chunk.T for chunk in sampler(chunk_size, rng, skip, **constraints)):
+        yield np.column_stack((r*np.cos(theta), r*np.sin(theta)))
 
-def polar_uniform_generator(tmplt_class, **constraints):
+
+def cartesian_uniform_generator(tmplt_class, chunk_size=65536, rng=None, skip=0, **constraints):
+    """Uniformly generate templates, here (x1, x2, ...) denotes for the Cartesian (x, y, ...)."""
+    for chunk in cartesian_uniform_chunks(chunk_size, rng, skip, **constraints):
+        for params in chunk.tolist():
+            yield tmplt_class(*params)
+
+
+def polar_uniform_generator(tmplt_class, chunk_size=65536, rng=None, skip=0, **constraints):
     """Uniformly generate templates in 2d, here (x1, x2) denotes for (r, theta), where r>=0, theta in [0, 2*pi]."""
-    for x1, x2 in uniform_points_generator(**constraints):
-        yield tmplt_class(x1*np.cos(x2), x1*np.sin(x2))
+    for chunk in polar_uniform_chunks(chunk_size, rng, skip, **constraints):
+        for x1, x2 in chunk.tolist():
+            yield tmplt_class(x1, x2)
+
+
+class MetricTemplate(object):
+    """
+    Base class of the template classes, whose quantities derived from the (class-level) metric are computed
+     once, when the class (or a subclass) is created.
+    """
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._factorize_metric()
+
+    @classmethod
+    def _factorize_metric(cls):
+        """Precompute the Cholesky factor and the bounding box of the ellipse of the metric, return the metric."""
+        metric = np.asarray(cls.metric, dtype=float)
+        # metric = L L^T, so that |dx L| is the proper distance for row vectors dx
+        cls.chol = np.linalg.cholesky(metric)
+        # half sizes of the bounding box of the ellipse at unit distance
+        cls.half_axes = np.sqrt(np.diag(np.linalg.inv(metric)))
+        return metric
+
+    def __repr__(self):
+        return "(%s)" % ", ".join(self.param_formats) % self.params
 
 
-class BasicTemplate(object):
-    """Basic class, i.e. the class corresponds to Cartesian coordinates."""
+class BasicTemplate(MetricTemplate):
+    """
+    Basic class, i.e. the class corresponds to Cartesian coordinates.
+    The quantities derived from the metric are computed once, when the class (or a subclass) is created.
+    """
     __slots__ = ("x1", "x2", "norm", "is_seed_point", "ellipse")
+    ndim = 2
     param_names = ("x1", "x2")
     param_formats = ("%.4f", "%.4f")
     metric = np.array([[1, 0], [0, 1]])
-    vals, vecs = np.linalg.eig(np.linalg.inv(metric))
-    ang = float(np.degrees(np.arctan2(vecs[1, 0], vecs[0, 0])))
+    varying_metric = False
+
+    @classmethod
+    def _factorize_metric(cls):
+        """Precompute the coefficients, Cholesky factor, and ellipse shape of the (constant) metric."""
+        metric = super()._factorize_metric()
+        # ds^2 = a dx1^2 + b dx1 dx2 + c dx2^2
+        cls.coeffs = (float(metric[0, 0]), float(metric[0, 1] + metric[1, 0]), float(metric[1, 1]))
+        cls.vals, cls.vecs = np.linalg.eig(np.linalg.inv(metric))
+        cls.ang = float(np.degrees(np.arctan2(cls.vecs[1, 0], cls.vecs[0, 0])))
+        return metric
 
     def __init__(self, x1, x2):
-        self.x1 = float(x1)
-        self.x2 = float(x2)
+        self.x1 = x1 = float(x1)
+        self.x2 = x2 = float(x2)
         # TODO: x1, x2 attributes may denote different quantities with those in sbank.py (rename them?)
-        norm_sq = float(np.linalg.multi_dot([[x1, x2], self.metric, [[x1], [x2]]]))
-        self.norm = norm_sq**0.5
+        a, b, c = self.coeffs
+        self.norm = sqrt(a*x1*x1 + b*x1*x2 + c*x2*x2)
         self.ellipse = None
 
     @property
     def params(self):
         return tuple(getattr(self, k) for k in self.param_names)
 
-    def __repr__(self):
-        return "(%s)" % ", ".join(self.param_formats) % self.params
+    @classmethod
+    def distance(cls, dx1, dx2):
+        """Proper length of the displacement (dx1, dx2), on plain floats."""
+        a, b, c = cls.coeffs
+        return sqrt(a*dx1*dx1 + b*dx1*dx2 + c*dx2*dx2)
+
+    @classmethod
+    def distances(cls, dx, coeffs=None):
+        """
+        Batched distance(): proper lengths of the displacements in the rows of dx, an (..., 2) array.
+        It gives the very same floats as distance() and proper_distance().
+        coeffs, an (..., 3) array of the metric coefficients for each displacement (see coeffs_at()),
+         defaults to the class metric.
+        """
+        a, b, c = cls.coeffs if coeffs is None else np.moveaxis(coeffs, -1, 0)
+        dx1, dx2 = dx[..., 0], dx[..., 1]
+        return np.sqrt(a*dx1*dx1 + b*dx1*dx2 + c*dx2*dx2)
 
     def proper_distance(self, other):
         dx1, dx2 = other.x1-self.x1, other.x2-self.x2
-        dis_sq = float(np.linalg.multi_dot([[dx1, dx2], self.metric, [[dx1], [dx2]]]))
-        return dis_sq**0.5
+        a, b, c = self.coeffs
+        return sqrt(a*dx1*dx1 + b*dx1*dx2 + c*dx2*dx2)
+
+    @classmethod
+    def coeffs_at(cls, params):
+        """Return the metric coefficients (a, b, c) at the points in the rows of params as an (m, 3) array."""
+        return np.tile(cls.coeffs, (len(params), 1))
+
+    @classmethod
+    def ellipses(cls, params, max_distance):
+        """Return the widths, heights and angles (in degrees) of the ellipses of the templates at params."""
+        w, h = 2*max_distance*np.sqrt(cls.vals)
+        m = len(params)
+        return np.full(m, w), np.full(m, h), np.full(m, cls.ang)
 
     def get_ellipse(self, max_distance, c):
         """Provide a ellipse patch for drawing figures."""
         if not self.ellipse:
+            from matplotlib.patches import Ellipse
             w, h = 2*max_distance*np.sqrt(self.vals)
             self.ellipse = Ellipse((self.x1, self.x2), width=w, height=h, angle=self.ang, color=c, alpha=0.2)
         return self.ellipse
 
 
+class LocalMetricTemplate(BasicTemplate):
+    """
+    Base class of templates whose metric depends on the position, as given by metric_at(x1, x2).
+    The distance from a template to another point is measured with the metric at the template, which is
+     evaluated when first needed and then cached (on the template here, and for each row in a Bank).
+    The class-level metric is only a representative one, used for the norm and to size the neighborhoods.
+    """
+    __slots__ = ("_local",)
+    varying_metric = True
+
+    def __init__(self, x1, x2):
+        super().__init__(x1, x2)
+        self._local = None
+
+    @classmethod
+    def metric_at(cls, x1, x2):
+        """Return the metric at (x1, x2) as a 2x2 array."""
+        raise NotImplementedError
+
+    @classmethod
+    def coeffs_at(cls, params):
+        """
+        Return the metric coefficients (a, b, c) at the points in the rows of params as an (m, 3) array.
+        This calls metric_at() point by point, subclasses had better override it with a vectorized version.
+        """
+        metrics = np.array([cls.metric_at(x1, x2) for x1, x2 in np.reshape(params, (-1, 2)).tolist()],
+                           dtype=float).reshape(-1, 2, 2)
+        return np.column_stack((metrics[:, 0, 0], metrics[:, 0, 1] + metrics[:, 1, 0], metrics[:, 1, 1]))
+
+    @property
+    def local_coeffs(self):
+        """The metric coefficients (a, b, c) at this template."""
+        if self._local is None:
+            self._local = tuple(self.coeffs_at(np.array([self.params]))[0].tolist())
+        return self._local
+
+    def proper_distance(self, other):
+        dx1, dx2 = other.x1-self.x1, other.x2-self.x2
+        a, b, c = self.local_coeffs
+        return sqrt(a*dx1*dx1 + b*dx1*dx2 + c*dx2*dx2)
+
+    @classmethod
+    def ellipses(cls, params, max_distance):
+        a, b, c = cls.coeffs_at(params).T
+        metrics = np.stack((np.column_stack((a, b/2)), np.column_stack((b/2, c))), axis=1)
+        vals, vecs = np.linalg.eig(np.linalg.inv(metrics))
+        w, h = 2*max_distance*np.sqrt(vals.T)
+        return w, h, np.degrees(np.arctan2(vecs[:, 1, 0], vecs[:, 0, 0]))
+
+    def get_ellipse(self, max_distance, c):
+        if not self.ellipse:
+            from matplotlib.patches import Ellipse
+            w, h, ang = (float(i[0]) for i in self.ellipses(np.array([self.params]), max_distance))
+            self.ellipse = Ellipse((self.x1, self.x2), width=w, height=h, angle=ang, color=c, alpha=0.2)
+        return self.ellipse
+
+
+class PolarTemplate(LocalMetricTemplate):
+    """
+    The class for polar coordinates (x1, x2) = (r, theta) with their true line element
+     ds^2 = dr^2 + r^2 dtheta^2, i.e. the ellipses get wider in theta toward the origin.
+    Note that theta is not wrapped around, the edges theta = 0 and 2*pi are not regarded as near.
+    The representative metric is the one at r = 1.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def metric_at(cls, x1, x2):
+        return np.array([[1, 0], [0, x1**2]])
+
+    @classmethod
+    def coeffs_at(cls, params):
+        r = np.reshape(params, (-1, 2))[:, 0]
+        return np.column_stack((np.ones_like(r), np.zeros_like(r), r*r))
+
+
 class ScaledEuclidTemplate(BasicTemplate):
     """The class for a scaled Euclidean coordinates, i.e. we stretch the x1-direction with a factor of 2.
      Actually you can arbitrarily change the metric as long as it is not singular,
      non-diagonal matrix will give a rotate ellipse, e.g. you can override the metric using [[1/4, 1/4], [1/4, 1]].
     """
     metric = np.array([[1/4, 0], [0, 1]])
-    vals, vecs = np.linalg.eig(np.linalg.inv(metric))
-    ang = float(np.degrees(np.arctan2(vecs[1, 0], vecs[0, 0])))
+
+
+class NDTemplate(MetricTemplate):
+    """
+    Template in a space of any dimension d with a constant metric (a d x d matrix), whose parameters
+     are (x1, ..., xd); the dimension is set by the metric of the class.
+    The distances are computed in the coordinates whitened by the Cholesky factor of the metric,
+     which is precomputed once, when the class (or a subclass) is created, as for BasicTemplate.
+    """
+    __slots__ = ("params", "norm", "is_seed_point")
+    metric = np.eye(3)
+    varying_metric = False
+
+    @classmethod
+    def _factorize_metric(cls):
+        """Precompute the dimension, Cholesky factor and ellipsoid shape of the metric."""
+        metric = super()._factorize_metric()
+        cls.ndim = len(metric)
+        cls.param_names = tuple("x%d" % i for i in range(1, cls.ndim + 1))
+        cls.param_formats = ("%.4f",) * cls.ndim
+        cls.vals = np.linalg.eigvalsh(np.linalg.inv(metric))
+        return metric
+
+    def __init__(self, *params):
+        if len(params) != self.ndim:
+            raise ValueError("%s takes %d parameters, got %d." % (type(self).__name__, self.ndim, len(params)))
+        self.params = tuple(float(x) for x in params)
+        self.norm = float(self.distances(np.array(self.params)))
+
+    @classmethod
+    def distances(cls, dx, coeffs=None):
+        """Proper lengths of the displacements in the rows of dx, an (..., d) array; coeffs is ignored."""
+        y = dx @ cls.chol
+        return np.sqrt(np.einsum('...i,...i->...', y, y))
+
+    def proper_distance(self, other):
+        return float(self.distances(np.subtract(other.params, self.params)))
+
+
+class Cartesian3DTemplate(NDTemplate):
+    """The class for 3d Cartesian coordinates."""
+    __slots__ = ()
+    metric = np.eye(3)
+
+
+class Cartesian4DTemplate(NDTemplate):
+    """The class for 4d Cartesian coordinates."""
+    __slots__ = ()
+    metric = np.eye(4)
+
+
+class Cartesian5DTemplate(NDTemplate):
+    """The class for 5d Cartesian coordinates."""
+    __slots__ = ()
+    metric = np.eye(5)
+
+
+class Cartesian6DTemplate(NDTemplate):
+    """The class for 6d Cartesian coordinates."""
+    __slots__ = ()
+    metric = np.eye(6)
 
 
 proposals = {'Cartesian': cartesian_uniform_generator,
              'Polar': polar_uniform_generator,
              'ScaledEuclidean': cartesian_uniform_generator,
+             'PolarMetric': cartesian_uniform_generator,
+             'Cartesian3D': cartesian_uniform_generator,
+             'Cartesian4D': cartesian_uniform_generator,
+             'Cartesian5D': cartesian_uniform_generator,
+             'Cartesian6D': cartesian_uniform_generator,
              }
+samplers = {'uniform': uniform_points_chunks,
+            'halton': halton_points_chunks,
+            'sobol': sobol_points_chunks,
+            'adaptive': adaptive_points_chunks,
+            }
+proposal_chunks = {'Cartesian': cartesian_uniform_chunks,
+                   'Polar': polar_uniform_chunks,
+                   'ScaledEuclidean': cartesian_uniform_chunks,
+                   'PolarMetric': cartesian_uniform_chunks,
+                   'Cartesian3D': cartesian_uniform_chunks,
+                   'Cartesian4D': cartesian_uniform_chunks,
+                   'Cartesian5D': cartesian_uniform_chunks,
+                   'Cartesian6D': cartesian_uniform_chunks,
+                   }
 coord_frames = {'Cartesian': BasicTemplate,
                 'Polar': BasicTemplate,
                 'ScaledEuclidean': ScaledEuclidTemplate,
+                'PolarMetric': PolarTemplate,
+                'Cartesian3D': Cartesian3DTemplate,
+                'Cartesian4D': Cartesian4DTemplate,
+                'Cartesian5D': Cartesian5DTemplate,
+                'Cartesian6D': Cartesian6DTemplate,
                 }
+# the largest number of parameters of the coord frames
+max_ndim = max(tmplt_class.ndim for tmplt_class in coord_frames.values())
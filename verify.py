@@ -0,0 +1,180 @@
+"""
+This code checks how well a finished bank covers the parameter space, type
+```shell
+python3 verify.py --help
+```
+in command line for further help docs.
+
+Injection points are drawn uniformly (as the proposals of sbank.py) and the distance of each one to its nearest
+ template is computed in chunks, vectorized over the pairs found by a neighborhood index of the bank, e.g.
+```shell
+python3 verify.py test.bank --injections 10000000 --workers 8
+```
+The chunks are drawn from their own random streams, so the result does not depend on the number of workers.
+"""
+from multiprocessing import Pool
+from optparse import OptionParser
+import json
+import os
+import sys
+
+import numpy as np
+
+from bank import Bank, nhood_indices
+import bankfile
+from templates import coord_frames, max_ndim, proposal_chunks
+
+# the bank of a worker process, see _init_worker()
+_bank = None
+
+
+def _init_worker(params, tmplt_class, nhood_param, nhood_size):
+    """Build the bank of params with its neighborhood index in the (worker) process, as _bank; prune.py shares it."""
+    global _bank
+    _bank = Bank.from_array(params, tmplt_class, nhood_size, nhood_param)
+
+
+def _verify_chunk(args):
+    """Draw the injections of one chunk and return the distances to their nearest templates."""
+    coord_frame, constraints, size, seed, chunk, search_distance = args
+    rng = np.random.default_rng([seed, chunk])
+    points = next(proposal_chunks[coord_frame](size, rng, **constraints))
+    return _bank.min_distances(points, search_distance)
+
+
+def nearest_distances(params, coord_frame, constraints, n_injections, search_distance, nhood_param='grid',
+                      nhood_size=None, workers=1, seed=42, chunk_size=65536):
+    """
+    Draw n_injections points within constraints and return the distances to their nearest templates in params
+     (an (n, d) array), np.inf for those without any template within search_distance.
+    With nhood_param grid (the default) or kdtree, every distance within search_distance is exact; with a window
+     index, the nearest template is searched within nhood_size of the injection, by default search_distance times
+     the largest half axis of the ellipses (which holds every template within search_distance).
+    """
+    tmplt_class = coord_frames[coord_frame]
+    if nhood_param == 'grid':
+        nhood_size = search_distance * np.sqrt(max(tmplt_class.vals))
+    elif nhood_size is None:
+        nhood_size = search_distance * max(tmplt_class.half_axes)
+    sizes = [min(chunk_size, n_injections - start) for start in range(0, n_injections, chunk_size)]
+    tasks = [(coord_frame, constraints, size, seed, chunk, search_distance) for chunk, size in enumerate(sizes)]
+    init_args = (params, tmplt_class, nhood_param, nhood_size)
+    if workers == 1:
+        _init_worker(*init_args)
+        results = list(map(_verify_chunk, tasks))
+    else:
+        with Pool(workers, _init_worker, init_args) as pool:
+            results = pool.map(_verify_chunk, tasks)
+    return np.concatenate(results) if results else np.empty(0)
+
+
+def summarize(distances, distance_max, search_distance, n_bins=20):
+    """Return the coverage statistics of the distances to the nearest templates as a dict."""
+    n = len(distances)
+    quantiles = (0.5, 0.9, 0.99, 0.999, 1.)
+    # the distances beyond search_distance are only known to be larger, which sorts them last
+    values = np.quantile(distances, quantiles) if n else np.full(len(quantiles), np.nan)
+    counts, edges = np.histogram(distances[np.isfinite(distances)], bins=n_bins, range=(0., search_distance))
+    return {'injections': n, 'distance_max': distance_max, 'search_distance': search_distance,
+            'fraction_beyond_distance_max': float(np.count_nonzero(distances > distance_max) / n) if n else None,
+            'fraction_beyond_search_distance': float(np.count_nonzero(~np.isfinite(distances)) / n) if n else None,
+            'mean': float(np.mean(distances[np.isfinite(distances)])) if np.isfinite(distances).any() else None,
+            'quantiles': {str(q): (float(v) if np.isfinite(v) else None) for q, v in zip(quantiles, values)},
+            'histogram': {'edges': edges.tolist(), 'counts': counts.tolist()}}
+
+
+def fill_options(opts, header):
+    """
+    Fill in the options of the run which made the bank (frame, limits and distance_max) that are not given
+     with those in the header of its bank file, and choose the neighborhood index.
+    The limits of the axes beyond x2 default to those of x1, as for sbank.py.
+    Exit if some are missing, return the template class and the neighborhood param.
+    """
+    limits = ["x%d_%s" % (i, end) for i in range(1, max_ndim + 1) for end in ("min", "max")]
+    for key in ["coord_frame", "distance_max"] + limits:
+        if getattr(opts, key) is None:
+            setattr(opts, key, header.get(key))
+    if opts.distance_max is None:
+        opts.distance_max = 0.1
+    for key in ("coord_frame", "x1_min", "x1_max"):
+        if getattr(opts, key) is None:
+            sys.exit("--%s is required for a bank without header." % key.replace("_", "-"))
+    polar = opts.coord_frame in ('Polar', 'PolarMetric')
+    if opts.x2_min is None:
+        opts.x2_min = 0. if polar else opts.x1_min
+    if opts.x2_max is None:
+        opts.x2_max = 2 * np.pi if polar else opts.x1_max
+    tmplt_class = coord_frames[opts.coord_frame]
+    for key in limits[4:2 * tmplt_class.ndim]:
+        if getattr(opts, key) is None:
+            setattr(opts, key, getattr(opts, "x1_" + key[-3:]))
+    nhood_param = opts.neighborhood_param or ('x1' if tmplt_class.varying_metric else 'grid')
+    if tmplt_class.varying_metric and nhood_param in ('grid', 'kdtree'):
+        sys.exit("--neighborhood-param %s needs a constant metric." % nhood_param)
+    return tmplt_class, nhood_param
+
+
+def add_bank_options(parser):
+    """Add the options describing the bank (and its neighborhood index) to parser."""
+    parser.add_option("--coord-frame", choices=list(coord_frames.keys()), metavar='|'.join(coord_frames.keys()),
+                      help="Coordinate frame of the bank. Default: the one in the header of a bank file, required for a .npy bank.")
+    for opt in ("x%d-%s" % (i, end) for i in range(1, max_ndim + 1) for end in ("min", "max")):
+        parser.add_option("--" + opt, type="float", metavar="FLOAT",
+                          help="Limit of the parameter space, as for sbank.py. Default: the one in the header of a bank file.")
+    parser.add_option("--distance-max", type="float", default=None,
+                      help="Distance which the bank should cover. Default: the one in the header of a bank file, else 0.1.")
+    parser.add_option("--neighborhood-param", choices=list(nhood_indices.keys()), default=None,
+                      help="Neighborhood index searched for the templates near a point. Default grid, or x1 for a position-dependent metric. Only grid and kdtree give exact distances whatever the metric.")
+
+
+def parse_command_line():
+    parser = OptionParser(usage="%prog [options] BANK")
+    add_bank_options(parser)
+    parser.add_option("--search-distance", type="float", default=None,
+                      help="Largest distance to the nearest template which is computed, injections farther away are only counted as such. Default: twice --distance-max.")
+    parser.add_option("--injections", type="int", metavar="N", default=100000,
+                      help="Number of injection points. Default 100000.")
+    parser.add_option("--neighborhood-size", type="float", metavar="FLOAT", default=None,
+                      help="Window of the x1, x2 and norm indices. Default: --search-distance times the largest half axis of the ellipses.")
+    parser.add_option("--workers", type="int", metavar="N", default=1,
+                      help="Evaluate the chunks of injections in N processes. Default 1.")
+    parser.add_option("--seed", type="int", metavar="INT", default=42,
+                      help="Seed of the injections.")
+    parser.add_option("--output-file", metavar="FILE", default=None,
+                      help="Write the statistics as JSON to FILE instead of the standard output.")
+    parser.add_option("--distances-file", metavar="FILE", default=None,
+                      help="Save the distances of all the injections to FILE (.npy).")
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("exactly one bank is required.")
+    if opts.workers < 1 or opts.injections < 1:
+        parser.error("--workers and --injections must be positive integers.")
+    return opts, args
+
+
+def main():
+    opts, args = parse_command_line()
+    params, header = bankfile.load_params(args[0])
+    tmplt_class, nhood_param = fill_options(opts, header)
+    search_distance = opts.search_distance or 2 * opts.distance_max
+
+    constraints = {'x%d' % i: (getattr(opts, 'x%d_min' % i), getattr(opts, 'x%d_max' % i))
+                   for i in range(1, tmplt_class.ndim + 1)}
+    distances = nearest_distances(params, opts.coord_frame, constraints, opts.injections, search_distance,
+                                  nhood_param, opts.neighborhood_size, opts.workers, opts.seed)
+    if opts.distances_file:
+        np.save(opts.distances_file, distances)
+    result = dict(summarize(distances, opts.distance_max, search_distance), bank=os.path.abspath(args[0]),
+                  templates=len(params), coord_frame=opts.coord_frame, neighborhood_param=nhood_param)
+    if opts.output_file:
+        with open(opts.output_file, 'w') as f:
+            json.dump(result, f, indent=1)
+    else:
+        json.dump(result, sys.stdout, indent=1)
+        print()
+    print("%.4g%% of %d injections are farther than %g from the bank." %
+          (100 * result['fraction_beyond_distance_max'], len(distances), opts.distance_max), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()